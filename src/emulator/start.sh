@@ -1,4 +1,8 @@
 #!/bin/bash
+# Set EMULATOR_CPUS (e.g. EMULATOR_CPUS=4-5) to pin the emulator to those CPUs, away from the trainer's --cpus.
 cd `dirname $0`
 cd build
+if [ -n "$EMULATOR_CPUS" ]; then
+    exec taskset -c "$EMULATOR_CPUS" ./mupen64plus --gfx mupen64plus-video-glide64mk2 ../sf.n64
+fi
 ./mupen64plus --gfx mupen64plus-video-glide64mk2 ../sf.n64
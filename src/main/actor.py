@@ -0,0 +1,61 @@
+# Background actor that plays the emulator while the learner trains
+
+import threading
+import time
+import traceback
+
+
+class Actor(object):
+    """Drives the emulator in its own thread for actor/learner training.
+
+    The actor plays `sync_every` steps at a time through DataManager.play, choosing actions with the model's actor
+    network, and copies the learner's current weights into that network after every chunk. Once the replay buffer
+    is warmed up, it pauses whenever it is more than one chunk ahead of the configured replay ratio, so that a slow
+    learner does not waste emulator frames. Transitions go into the shared (thread-safe) replay buffer, from which the
+    learner samples independently. session.run, the emulator socket and numpy all release the GIL, so acting and
+    training overlap.
+    """
+
+    def __init__(self, data_manager, sync_every):
+        self.data_manager = data_manager
+        self.sync_every = sync_every
+        self.max_score = 0
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.sync()
+        self.thread.start()
+
+    def sync(self):
+        self.data_manager.session.run(self.data_manager.foxnet.sync_actor_op)
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                if not self.data_manager.actor_may_play(self.sync_every):
+                    time.sleep(0.01)
+                    continue
+                self.max_score = self.data_manager.play(self.sync_every)
+                self.sync()
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def check(self):
+        """Re-raises an error that stopped the actor thread."""
+        if self.error is not None:
+            raise RuntimeError("Error in actor thread:\n" + self.error)
+
+    def wait_until(self, condition):
+        """Waits, while the actor keeps playing, until `condition()` is true."""
+        while not condition():
+            self.check()
+            time.sleep(0.01)
+        self.check()
+
+    def stop(self, timeout=30):
+        """Asks the actor to stop after its current chunk of steps."""
+        self.stopped.set()
+        self.thread.join(timeout)
@@ -1,70 +1,43 @@
 # Parcel data into usable format
 
 from collections import Counter
+import multiprocessing
 import numpy as np
 import os
-import re
 from sklearn.model_selection import train_test_split
 from scipy import ndimage
 from scipy import misc
 from tqdm import *
 
+from dataset_cache import DatasetCache
+from manifest import Manifest, manifest_dir
+
+# Recordings of which fewer frames than this are selected are not cached, since caching decodes every frame.
+CACHE_MIN_FRACTION = 0.5
+
 def load_datasets(tier, params):
-    print("##### LOADING DATA ########################################")
-    # Matching group 1 is frame number, matching group 2 is action
-    pattern = re.compile('i=(\d+)_a=(\w)(_s=(\d+)_h=(\d+))?.png')
+    """Loads the frames selected by params into one contiguous uint8 array and splits them into train and test sets.
 
+    Returns (states, actions, scores, healths), train_indices, test_indices. `states` is indexed by state: the frames
+    array itself, or a FrameStates view over it if params['multi_frame_state']. The label arrays are aligned with the
+    states, and the train/test sets are given as arrays of state indices, so no part of the data is copied.
+    """
+    print("##### LOADING DATA ########################################")
     # Load images
     print("Loading images:")
-    images = []
-    actions = []
-    scores = []
-    healths = []
-    action_counter = Counter()
-
     print("Actions: " + str(params['actions']))
 
-    for dirname in tqdm(os.listdir(params["data_dir"])):
-        for filename in tqdm(os.listdir(params["data_dir"] + '/' + dirname)):
-            # Stop early if have enough images
-            if params["num_images"] != -1 and len(images) >= params["num_images"]:
-                break
-
-            # Extract metadata
-            match = re.search(pattern, filename)
-            frame_number = match.group(1)
-            action = match.group(2)
-            score = 0
-            health = 0
-            if match.group(3) is not None:
-                score = int(match.group(4))
-                health = int(match.group(5))
-            
-            # Convert image and add to collection
-            # Shape of img is (480, 640, 3)
-
-            img = ndimage.imread(params["data_dir"] + '/' + dirname + '/' + filename)
-            img = misc.imresize(img, (params['height'], params['width']))
-
-            if img is not None and action in params["actions"]:
-                images.append(img)
-                actions.append(params["actions"].index(action))
-                action_counter[action] += 1
-                scores.append(score)
-                healths.append(health)
+    images, actions, scores, healths = load_images(params)
     print("Loaded " + str(len(images)) + " images.")
-    print("Action counts: " + str(action_counter))
 
     # Create states by adding a third dimension over n_frames frames
     # Final state has shape (n_frames, 48, 64, 3)
     # We discard the first (n_frames - 1) frames
+    # States are not materialized: each is identified by the index of its last frame, and FrameStates gathers the
+    # frames of a batch of states on demand.
     if (params["multi_frame_state"]):
-        print("Creating states:")
         n_frames = params["frames_per_state"]
-        states = []
-        for i in tqdm(np.arange(len(images) - n_frames + 1)):
-            state = tuple(images[x][None, :, :, :] for x in np.arange(i, i + n_frames))
-            states.append(np.concatenate(state, axis=0))
+        states = FrameStates(images, np.arange(n_frames - 1, len(images)), n_frames)
         actions = actions[n_frames - 1:] # Also remove (n_frames - 1) actions
         scores = scores[n_frames - 1:] # Also remove (n_frames - 1) actions
         healths = healths[n_frames - 1:] # Also remove (n_frames - 1) actions
@@ -73,32 +46,200 @@ def load_datasets(tier, params):
         states = images
 
     # Partition
-    s_train, s_test, a_train, a_test, scores_train, scores_test, h_train, h_test = \
-        train_test_split(states, actions, scores, healths, test_size=params["eval_proportion"], random_state=42)
-    print("Train count: " + str(len(s_train)) + ", Test count: " + str(len(s_test)))
-
-    # Convert from list to numpy array
-    print("Stacking...")
-    s_train = np.stack(s_train)
-    s_test = np.stack(s_test)
-    a_train = np.stack(a_train)
-    a_test = np.stack(a_test)
-    scores_train = np.stack(scores_train)
-    scores_test = np.stack(scores_test)
-    h_train = np.stack(h_train)
-    h_test = np.stack(h_test)
+    train_indices, test_indices = train_test_split(np.arange(len(states)), test_size=params["eval_proportion"],
+                                                   random_state=42)
+    print("Train count: " + str(len(train_indices)) + ", Test count: " + str(len(test_indices)))
 
     # Print stats
-    # Data: count (in train/test set) [x 3 (num frames) if multi_frame_state] x 48 (height) x 68 (width) x 3 (channels)
-    # Labels: count (in train/test set) x 1 (index of action in ACTIONS array)
-    print('Train states shape: ' + str(s_train.shape))
-    print('Train actions shape: ' + str(a_train.shape))
-    print('Train scores shape: ' + str(scores_train.shape))
-    print('Train healths shape: ' + str(h_train.shape))
-    print('Test states shape: ' + str(s_test.shape))
-    print('Test actions shape: ' + str(a_test.shape))
-    print('Test scores shape: ' + str(scores_test.shape))
-    print('Test healths shape: ' + str(h_test.shape))
+    # Data: count [x 3 (num frames) if multi_frame_state] x 48 (height) x 68 (width) x 3 (channels)
+    # Labels: count x 1 (index of action in ACTIONS array)
+    print('States shape: ' + str(states.shape))
+    print('Actions shape: ' + str(actions.shape))
+    print('Scores shape: ' + str(scores.shape))
+    print('Healths shape: ' + str(healths.shape))
 
     # Returns
-    return (s_train, a_train, scores_train, h_train), (s_test, a_test, scores_test, h_test)
+    return (states, actions, scores, healths), train_indices, test_indices
+
+class FrameStates(object):
+    """Multi-frame states backed by a single contiguous array of frames, each frame stored once.
+
+    State i consists of frames[last_frames[i] - frames_per_state + 1 : last_frames[i] + 1]. Indexing with an integer
+    array gathers the requested states into a new (len(idx), frames_per_state, height, width, channels) array, so only
+    the current batch is ever materialized.
+    """
+
+    def __init__(self, frames, last_frames, frames_per_state):
+        self.frames = frames
+        self.last_frames = np.asarray(last_frames)
+        self.offsets = np.arange(1 - frames_per_state, 1)
+        self.shape = (len(self.last_frames), frames_per_state) + tuple(frames.shape[1:])
+
+    def __len__(self):
+        return len(self.last_frames)
+
+    def __getitem__(self, idx):
+        return self.frames[self.last_frames[idx][..., None] + self.offsets]
+
+def select_frames(params):
+    """Chooses which frames to load using only the recording manifests, without touching image bytes.
+
+    Recording directories are visited in sorted order and frames within a directory in frame-number order. Frames
+    whose action is not in params['actions'] are skipped, every params['subsample']-th remaining frame is kept, and
+    selection stops once params['num_images'] frames are chosen.
+
+    Returns a list of (dirname, rows, positions): the manifest rows of the directory restricted to known actions, and
+    the positions within those rows that were selected.
+    """
+    manifest = Manifest(params["data_dir"], manifest_dir(params.get("manifest_dir"), params["data_dir"]))
+    num_images = params["num_images"]
+    subsample = params.get("subsample", 1)
+
+    selection = []
+    total = 0
+    for dirname in sorted(os.listdir(params["data_dir"])):
+        # Stop early if have enough images
+        if num_images != -1 and total >= num_images:
+            break
+        rows = manifest.load(dirname)
+        keep = np.array([action in params["actions"] for action in rows['action']], dtype=bool)
+        rows = dict((field, values[keep]) for field, values in rows.items())
+        positions = np.arange(0, len(rows['filename']), subsample)
+        if num_images != -1:
+            positions = positions[:num_images - total]
+        selection.append((dirname, rows, positions))
+        total += len(positions)
+
+    action_counter = Counter()
+    num_bytes = 0
+    for _, rows, positions in selection:
+        action_counter.update(rows['action'][positions].tolist())
+        num_bytes += np.sum(rows['size'][positions])
+    print("Selected " + str(total) + " images (" + str(num_bytes // 2**20) + " MB) from " + str(len(selection)) +
+          " directories.")
+    print("Action counts: " + str(action_counter))
+    return selection
+
+def load_images(params):
+    """Loads the frames chosen by select_frames, decoding them or reading them from the DatasetCache if
+    params['cache_dir'] is set. A recording that is not cached yet is only decoded into the cache if at least
+    CACHE_MIN_FRACTION of its frames are selected; otherwise only the selected frames are decoded. Returns (images,
+    actions, scores, healths) as numpy arrays."""
+    selection = select_frames(params)
+
+    actions, scores, healths = [[np.zeros(0, dtype=np.int64)] for _ in range(3)]
+    for _, rows, positions in selection:
+        actions.append(np.array([params["actions"].index(a) for a in rows['action'][positions]], dtype=np.int64))
+        scores.append(rows['score'][positions])
+        healths.append(rows['health'][positions])
+    actions, scores, healths = np.concatenate(actions), np.concatenate(scores), np.concatenate(healths)
+
+    if not params.get("cache_dir"):
+        paths = [os.path.join(params["data_dir"], dirname, filename)
+                 for dirname, rows, positions in selection for filename in rows['filename'][positions]]
+        return decode_images(paths, params, params.get("num_workers", 1)), actions, scores, healths
+
+    cache = DatasetCache(params["cache_dir"], params["data_dir"], params["height"], params["width"], params["actions"])
+    frames = None
+    start = 0
+    for dirname, rows, positions in selection:
+        entry = cache.load(dirname, rows['filename'])
+        if entry is None and len(positions) < CACHE_MIN_FRACTION * len(rows['filename']):
+            print("Decoding " + str(len(positions)) + " selected frames of " + dirname + " without caching it")
+            paths = [os.path.join(params["data_dir"], dirname, filename) for filename in rows['filename'][positions]]
+            selected = decode_images(paths, params, params.get("num_workers", 1))
+        else:
+            if entry is None:
+                print("Decoding " + dirname + " into cache " + cache.root)
+                entry = decode_directory_into_cache(cache, params, dirname, rows)
+            else:
+                print("Using cached " + dirname + " (" + str(len(entry['frames'])) + " frames)")
+            selected = None
+        if frames is None:
+            total = sum(len(p) for _, _, p in selection)
+            shape = selected.shape[1:] if selected is not None else entry['frames'].shape[1:]
+            frames = np.empty((total,) + shape, dtype=np.uint8)
+        if selected is not None:
+            frames[start:start + len(positions)] = selected
+            del selected
+        else:
+            # Gather straight into the output so the selected frames are only copied once.
+            np.take(entry['frames'], positions, axis=0, out=frames[start:start + len(positions)])
+        start += len(positions)
+    if frames is None:
+        return decode_images([], params), actions, scores, healths
+    return frames, actions, scores, healths
+
+def decode_directory_into_cache(cache, params, dirname, rows):
+    """Decodes every frame of one recording directory with a known action straight into a new cache entry."""
+    paths = [os.path.join(params["data_dir"], dirname, filename) for filename in rows['filename']]
+    frames, frames_path = cache.begin(dirname, (len(paths),) + frame_shape(paths, params))
+    decode_images(paths, params, params.get("num_workers", 1), out=frames, out_path=frames_path)
+    actions = np.array([params["actions"].index(a) for a in rows['action']], dtype=np.int64)
+    return cache.commit(dirname, rows['filename'], frames, actions, rows['score'], rows['health'])
+
+def decode_image(path, params):
+    # Shape of the decoded img is (480, 640, 3)
+    img = ndimage.imread(path)
+    return misc.imresize(img, (params['height'], params['width']))
+
+def frame_shape(paths, params):
+    """Shape of a single decoded frame, found by decoding the first path."""
+    if not paths:
+        return (params['height'], params['width'], 3)
+    return decode_image(paths[0], params).shape
+
+def decode_images(paths, params, num_workers=1, out=None, out_path=None):
+    """Decodes and resizes `paths` into a uint8 array of shape (len(paths), height, width, channels), in order.
+
+    With num_workers > 1 the files are split into chunks that are decoded by a pool of processes, each writing its
+    frames directly into a preallocated shared array: either the .npy file at `out_path` that backs `out` (used by
+    the cache), or an anonymous shared-memory block. Every chunk owns a fixed slice of the output, so the final order
+    does not depend on which worker finishes first.
+    """
+    parallel = num_workers > 1 and len(paths) > 1
+    if out is None:
+        shape = (len(paths),) + frame_shape(paths, params)
+        if parallel:
+            shared = multiprocessing.RawArray('B', int(np.prod(shape)))
+            out = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+            _decode_in_pool(paths, params, num_workers, ('raw', shared, shape))
+            return out
+        out = np.empty(shape, dtype=np.uint8)
+    if parallel and out_path is not None:
+        out.flush()
+        _decode_in_pool(paths, params, num_workers, ('npy', out_path, None))
+        return out
+    for i in tqdm(np.arange(len(paths))):
+        out[i] = decode_image(paths[i], params)
+    return out
+
+# Shared output array of the current worker process, set up by _init_decode_worker.
+_worker_out = None
+
+def _init_decode_worker(target):
+    global _worker_out
+    kind, source, shape = target
+    if kind == 'raw':
+        _worker_out = np.frombuffer(source, dtype=np.uint8).reshape(shape)
+    else:
+        _worker_out = np.load(source, mmap_mode='r+')
+
+def _decode_chunk(args):
+    start, paths, params = args
+    for i, path in enumerate(paths):
+        _worker_out[start + i] = decode_image(path, params)
+    if isinstance(_worker_out, np.memmap):
+        _worker_out.flush()
+    return len(paths)
+
+def _decode_in_pool(paths, params, num_workers, target, chunk_size=64):
+    chunks = [(i, paths[i:i + chunk_size], params) for i in range(0, len(paths), chunk_size)]
+    pool = multiprocessing.Pool(num_workers, initializer=_init_decode_worker, initargs=(target,))
+    try:
+        with tqdm(total=len(paths)) as progress:
+            for n in pool.imap_unordered(_decode_chunk, chunks):
+                progress.update(n)
+    finally:
+        pool.close()
+        pool.join()
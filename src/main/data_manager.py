@@ -1,86 +1,200 @@
-from emu_interact import FrameReader
-from health.health import HealthExtractor
-from reward.knn_extract_reward_online import RewardExtractor
-from menu.menu_navigator import MenuNavigator
+from actor import Actor
 from data import load_datasets
-from replay_buffer import ReplayBuffer
+from environment import Emulator
+from input_pipeline import BackgroundPrefetcher, StreamingDataset
+from replay_buffer import PrioritizedReplayBuffer, ReplayBuffer
+import json
 import numpy as np
 import math
+import os
+import threading
+import time
 
 
 class DataManager:
     def __init__(self, verbose=False):
         self.is_online = False
         self.verbose = verbose
-
-    def init_online(self, foxnet, session, batch_size, replay_buffer_size, frames_per_state, ip, image_height,
-                    image_width, epsilon, user_overwrite=False):
+        self.stream = None
+        self.prefetcher = None
+        self.actor = None
+        # Set when the prefetched replay batch is handed out, so that the prefetch thread samples the next one.
+        self.replay_batch_taken = threading.Event()
+        self.prioritized_replay = False
+        # Importance-sampling weights and replay buffer indices of the last batch, with prioritized replay.
+        self.batch_weights = None
+        self.batch_idxes = None
+        # States n steps after those of the last online batch, and whether the episode ended before them.
+        self.batch_next_states = None
+        self.batch_done_mask = None
+        # State saved by the learner with the snapshot it was resumed from.
+        self.learner_state = {}
+
+    def init_online(self, foxnet, session, batch_size, replay_buffer_size, frames_per_state, emulators, image_height,
+                    image_width, epsilon, user_overwrite=False, prefetch_replay=False, actor_learner=False,
+                    actor_sync_every=1000, prioritized_replay=False, priority_alpha=0.6, priority_beta=0.4,
+                    priority_beta_steps=100000, replay_obs_dir=None, replay_compress_frames=False, n_step=1,
+                    replay_memory_budget=None, train_steps_per_play=1, env_steps_per_play=None, replay_warmup=0,
+                    resume_dir=None, inference_run_options=None):
+        """`emulators` is a list of (ip, port) pairs. All emulators are stepped in lockstep, with one batched
+        inference per step, and their transitions go into a single replay buffer.
+
+        With `prioritized_replay`, transitions are sampled in proportion to their TD error raised to `priority_alpha`,
+        and every batch comes with importance-sampling weights (see batch_weights), whose exponent is annealed
+        linearly from `priority_beta` to 1 over `priority_beta_steps` gradient steps.
+
+        With `replay_obs_dir`, the replay buffer keeps its frames in a memory-mapped file in that directory. With
+        `replay_compress_frames`, it keeps one compressed copy of every distinct frame instead. With
+        `replay_memory_budget` (in bytes), the buffer holds as many transitions as fit in that much RAM instead of
+        `replay_buffer_size`; since the size of compressed frames is not known up front, it cannot be combined with
+        `replay_compress_frames`. The buffer is allocated here, so an oversized buffer fails right away.
+
+        Batches hold `n_step`-step returns, discounted by the model's gamma, and come with the states n_step steps
+        later and whether the episode ended before them (see batch_next_states and batch_done_mask).
+
+        The replay ratio is `train_steps_per_play` training batches per `env_steps_per_play` environment steps
+        (batch_size by default). In actor/learner mode the learner waits for the actor when it gets ahead of that
+        ratio, and the actor waits for the learner when it gets more than one sync chunk ahead of it. No batch is
+        handed out before the replay buffer holds `replay_warmup` transitions.
+
+        With `resume_dir`, the replay buffer, epsilon and step counters are restored from the snapshot in that
+        directory, if there is one (see save_snapshot), before any emulator is played.
+
+        `inference_run_options` are the tf.RunOptions of the Q-value inferences used to act, e.g. to run them in
+        their own thread pool."""
         self.is_online = True
         self.foxnet = foxnet
         self.session = session
         self.batch_size = batch_size
         self.epsilon = epsilon
+        self.inference_run_options = inference_run_options
 
         # Allow player to overwrite for faster learning
         self.user_overwrite = user_overwrite
 
         # Initialize ReplayBuffer.
-        self.replay_buffer = ReplayBuffer(replay_buffer_size, frames_per_state)
+        # frames_per_state > 1 only for multi-frame architectures (dqn_3d), whose states are (frames, height, width,
+        # channels).
+        history_layout = 'frames' if frames_per_state > 1 else 'channels'
+        self.prioritized_replay = prioritized_replay
+        frame_shape = (image_height, image_width, int(foxnet.X.get_shape()[-1]))
+        buffer_class = PrioritizedReplayBuffer if prioritized_replay else ReplayBuffer
+        if replay_memory_budget:
+            assert not replay_compress_frames, "A replay memory budget cannot size a buffer of compressed frames"
+            replay_buffer_size = buffer_class.size_for_budget(replay_memory_budget, frame_shape,
+                                                              frames_in_ram=replay_obs_dir is None)
+            print("Replay buffer of %d transitions for a budget of %.1f MB" %
+                  (replay_buffer_size, replay_memory_budget / 2.0**20))
+        if prioritized_replay:
+            self.replay_buffer = PrioritizedReplayBuffer(replay_buffer_size, frames_per_state, priority_alpha,
+                                                         num_envs=len(emulators), history_layout=history_layout,
+                                                         obs_dir=replay_obs_dir,
+                                                         compress_frames=replay_compress_frames, n_step=n_step,
+                                                         gamma=foxnet.gamma, frame_shape=frame_shape)
+            self.priority_beta = priority_beta
+            self.priority_beta_steps = priority_beta_steps
+        else:
+            self.replay_buffer = ReplayBuffer(replay_buffer_size, frames_per_state, num_envs=len(emulators),
+                                              history_layout=history_layout, obs_dir=replay_obs_dir,
+                                              compress_frames=replay_compress_frames, n_step=n_step,
+                                              gamma=foxnet.gamma, frame_shape=frame_shape)
+
+        # Optionally sample the next minibatch in a background thread while the current training step runs.
+        self.prefetch_replay = prefetch_replay
+
+        # Replay ratio and warm-up.
+        self.train_steps_per_play = train_steps_per_play
+        self.env_steps_per_play = env_steps_per_play or batch_size
+        self.replay_warmup = replay_warmup
+        self.max_score = 0
 
         # Initialize emulator transfers
-        self.frame_reader = FrameReader(ip, image_height, image_width)
-        self.health_extractor = HealthExtractor()
-        self.reward_extractor = RewardExtractor()
-        self.menu_navigator = MenuNavigator()
+        self.emulators = [Emulator(ip, port, image_height, image_width, self.verbose) for ip, port in emulators]
 
-        # Keep full image for reward extraction.
-        frame, full_image = self.frame_reader.read_frame()
-        self.prev_frame = frame
-        self.prev_full_image = full_image
+        # Throughput counters: environment steps played and gradient steps (batches handed out) so far.
+        self.env_steps = 0
+        self.grad_steps = 0
+        self.last_report = (time.time(), 0, 0)
 
-        # Remember the health from the previous frame.
-        self.prev_health = None
+        # Replay sampling latency since the last replay report: number of samples, total and max seconds.
+        self.sample_stats = [0, 0.0, 0.0]
+
+        if resume_dir is not None:
+            self.load_snapshot(resume_dir)
+
+        # In actor/learner mode a background Actor plays the game with a periodically synced copy of the network,
+        # and get_next_batch only samples from the replay buffer.
+        if actor_learner:
+            self.actor = Actor(self, actor_sync_every)
+            self.actor.start()
 
     def init_offline(self, use_test_set, data_params, batch_size):
         self.is_online = False
         self.user_overwrite = False
         self.epsilon = 0 # Not used.
 
-        # Load the two pertinent datasets into train_dataset and eval_dataset
+        # Load the dataset once; the train and eval sets are index arrays into it.
         if use_test_set:
-            train_dataset, eval_dataset = load_datasets('test', data_params)
+            dataset, self.train_indices, self.eval_indices = load_datasets('test', data_params)
         else:
-            train_dataset, eval_dataset = load_datasets('dev', data_params)
+            dataset, self.train_indices, self.eval_indices = load_datasets('dev', data_params)
 
-        self.s_train, self.a_train, scores_train, h_train = train_dataset
-        self.s_eval, self.a_eval, scores_test, h_test = eval_dataset
+        self.states, self.actions, scores, healths = dataset
 
         # Compute the reward given scores and health. Currently, this just adds the two, weighting each one equally.
-        self.r_train = np.add(scores_train, h_train)
-        self.r_test = np.add(scores_test, h_test)
+        self.rewards = np.add(scores, healths)
 
         self.batch_size = batch_size
 
+    def init_streaming(self, data_params, batch_size, shuffle_buffer_size, prefetch_batches):
+        """Offline training that streams batches from the recordings instead of loading them into memory. Batches are
+        assembled in a background thread, `prefetch_batches` ahead of the training loop."""
+        self.is_online = False
+        self.user_overwrite = False
+        self.epsilon = 0 # Not used.
+
+        self.stream = StreamingDataset(data_params)
+        print("Streaming " + str(self.stream.num_examples()) + " train and " +
+              str(self.stream.num_examples(for_eval=True)) + " eval states.")
+
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.prefetch_batches = prefetch_batches
+
+    def num_examples(self, for_eval=False):
+        """Number of states in the offline train (or eval) set."""
+        if self.stream is not None:
+            return self.stream.num_examples(for_eval)
+        if for_eval:
+            return len(self.eval_indices)
+        return len(self.train_indices)
+
     def init_epoch(self, for_eval=False):
         self.batch_iteration = -1
 
         if self.is_online:
             pass
+        elif self.stream is not None:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+            batches = self.stream.batches(self.batch_size, for_eval, self.shuffle_buffer_size,
+                                          seed=np.random.randint(2**31))
+            self.prefetcher = BackgroundPrefetcher(batches, self.prefetch_batches)
+            self.next_batch = None
         else:
-            if for_eval: # "epoch" is entire validation set
-                self.epoch_indices = np.arange(self.s_eval.shape[0])
-            else:
-                self.epoch_indices = np.arange(self.s_train.shape[0])
+            # "epoch" is entire validation set when for_eval
+            self.epoch_indices = np.arange(self.num_examples(for_eval))
             np.random.shuffle(self.epoch_indices)
 
     def has_next_batch(self, for_eval=False):
         if self.is_online:
             return True
+        elif self.stream is not None:
+            if self.next_batch is None:
+                self.next_batch = self.prefetcher.get()
+            return self.next_batch is not None
         else:
-            if for_eval:
-                num_batch_iterations = int(math.ceil(self.s_eval.shape[0] / self.batch_size))
-            else:
-                num_batch_iterations = int(math.ceil(self.s_train.shape[0] / self.batch_size))
+            num_batch_iterations = int(math.ceil(self.num_examples(for_eval) / self.batch_size))
             return self.batch_iteration < num_batch_iterations
 
     def get_next_batch(self, for_eval=False):
@@ -90,123 +204,236 @@ class DataManager:
         max_score_batch = 0
 
         self.batch_iteration += 1
-        frame_skip = 5
 
         if self.is_online:
-            frame = self.prev_frame
-            full_image = self.prev_full_image
-
-            # Play the game for base_size frames.
-            i = 0
-            last_action_str = 'n'
-            last_frame_was_a_menu = False
-            while i < self.batch_size or not self.replay_buffer.can_sample(self.batch_size):
-                i += 1
-                for j in np.arange(frame_skip):
-                    self.frame_reader.send_action(last_action_str)
-                    frame, full_image = self.frame_reader.read_frame()
-
-                # As soon as the frame is the main menu, select the first option.
-                while self.menu_navigator.is_image_menu(full_image):
-                    # Alternate actions between l and j because j selects the option, but holding j does nothing.
-                    action_str = np.random.choice(['l', 'j'])
-                    if self.verbose:
-                        print('MENU DETECTED: Pressing l or j.'
-                              'Taking action: %s' % action_str)
-                    self.frame_reader.send_action(action_str)
-                    frame, full_image = self.frame_reader.read_frame()
+            if self.actor is None:
+                if self.grad_steps % self.train_steps_per_play == 0:
+                    self.max_score = self.play(self.env_steps_per_play)
+                max_score_batch = self.max_score
+            else:
+                self.actor.wait_until(self.can_train)
+                max_score_batch = self.actor.max_score
+            self.grad_steps += 1
+
+            if self.prefetch_replay:
+                if self.prefetcher is None:
+                    self.prefetcher = BackgroundPrefetcher(self._sample_replay_batches(), 1)
+                batch = self.prefetcher.get()
+                self.replay_batch_taken.set()
+            else:
+                batch = self._sample_replay_batch()
+            s_batch, a_batch, r_batch, self.batch_next_states, self.batch_done_mask = batch[:5]
+            if self.prioritized_replay:
+                self.batch_weights, self.batch_idxes = batch[5:]
+        elif self.stream is not None:
+            if self.next_batch is None:
+                self.next_batch = self.prefetcher.get()
+            s_batch, a_batch, r_batch = self.next_batch
+            self.next_batch = None
+        else:
+            # Choose which data to batch
+            if (for_eval):
+                indices = self.eval_indices
+            else:
+                indices = self.train_indices
+
+            # Generate indices for the batch.
+            start_idx = (self.batch_iteration * self.batch_size) % len(indices)
+            idx = indices[self.epoch_indices[start_idx: start_idx + self.batch_size]]
+
+            s_batch = self.states[idx]
+            a_batch = self.actions[idx]
+            if (not for_eval):
+                r_batch = self.rewards[idx]
 
-                # Store the most recent frame and get the past frames_per_state frames that define the current state.
-                replay_buffer_index = self.replay_buffer.store_frame(np.squeeze(frame))
-                state = self.replay_buffer.encode_recent_observation()
-                state = np.expand_dims(state, 0)
+        # print('Max score for current batch: %d' % max_score_batch)
+        return s_batch, a_batch, r_batch, max_score_batch
 
-                # Get the best action to take in the current state.
-                if last_frame_was_a_menu:
+    def play(self, num_steps):
+        """Plays the game for at least `num_steps` steps, and until the replay buffer can be sampled, storing every
+        transition in the replay buffer, and until the buffer is warmed up. Each step advances every emulator once.
+        Returns the max score seen."""
+        max_score = 0
+        frame_skip = 5
+        noop = self.foxnet.available_actions.index('n')
+
+        # Play the game for num_steps frames.
+        i = 0
+        while i < num_steps or not self.warmed_up():
+            i += len(self.emulators)
+            self.env_steps += len(self.emulators)
+            # Send to every emulator before reading from any, so they all emulate at the same time.
+            for j in np.arange(frame_skip):
+                for emulator in self.emulators:
+                    emulator.send_action(emulator.last_action_str)
+                for emulator in self.emulators:
+                    emulator.read_frame()
+
+            for emulator in self.emulators:
+                emulator.skip_menus()
+
+            # Store the most recent frames and get the past frames_per_state frames that define the current states.
+            replay_buffer_indices = self.replay_buffer.store_frames([np.squeeze(e.frame) for e in self.emulators])
+
+            # Get the best action to take in the current state of every emulator that is playing a level.
+            q_values = None
+            if not all(e.last_frame_was_a_menu for e in self.emulators):
+                q_values = self.q_values(self.replay_buffer.encode_recent_observations())
+
+            actions = []
+            for k, emulator in enumerate(self.emulators):
+                if emulator.last_frame_was_a_menu:
                     # We are not actually playing a level, so press 'l' or 'j' to get through the current menu/video.
                     action_str = np.random.choice(['l', 'j'])
                     if self.verbose:
                         print('NO SCORE DETECTED: Pressing l or j. '
                               'Taking action: %s' % action_str)
+                    # If the last frame was a menu/video, pretend we just did a noop.
+                    actions.append(noop)
                 else:
-                    feed_dict = {self.foxnet.X: state, self.foxnet.is_training: False}
-                    q_values_it = self.session.run(self.foxnet.probs, feed_dict=feed_dict)
-
                     action_str = 'n'
 
-                    if self.user_overwrite:
-                        action_str = self.frame_reader.get_keys()
+                    # The player can only overwrite the first emulator.
+                    if self.user_overwrite and k == 0:
+                        action_str = emulator.frame_reader.get_keys()
 
                     # If in user-overwrite and player does not input, do e-greedy
                     if action_str == 'n':
                         # e-greedy exploration.
                         if np.random.uniform() >= self.epsilon:
-                            action_str = self.foxnet.available_actions[np.argmax(q_values_it)]
+                            action_str = self.foxnet.available_actions[np.argmax(q_values[k])]
                         else:
                             action_str = np.random.choice(self.foxnet.available_actions)
-
-                # Send action to emulator.
-                self.frame_reader.send_action(action_str)
-
-                # Remember this action for the next iteration.
-                last_action_str = action_str
-
-                # Determine the action we will send to the replay buffer.
-                if last_frame_was_a_menu:
-                    # If the last frame was a menu/video, pretend we just did a noop.
-                    replay_buffer_str = self.foxnet.available_actions.index('n')
-                else:
-                    replay_buffer_str = self.foxnet.available_actions.index(action_str)
-
-                # Get the next frame.
-                new_frame, full_image = self.frame_reader.read_frame()
-
-                # Get the reward (score + health).
-                score_reward, score_is_not_digits = self.reward_extractor.get_reward(full_image)
-                last_frame_was_a_menu = score_is_not_digits
-                health_reward = self.health_extractor(full_image, offline=False)
-
-                if self.verbose and not last_frame_was_a_menu:
-                    print('Online reward extracted: score=%d\thealth=%f' % (score_reward, health_reward))
-
-                # Check if we just died.
-                if self.prev_health and self.prev_health > 0 and health_reward == 0:
-                    # Agent just died.
-                    if self.verbose:
-                        print('Agent just died. Setting health reward to -10.')
-                    health_reward = -10
-                self.prev_health = health_reward
-
-                reward = score_reward + health_reward
-                max_score_batch = max(score_reward, max_score_batch)
-
-                # Store the <s,a,r,s'> transition.
-                self.replay_buffer.store_effect(replay_buffer_index, replay_buffer_str, reward, False)
-                frame = new_frame
-
-            self.prev_frame = frame
-            self.prev_full_image = full_image
-
-            s_batch, a_batch, r_batch, _, _ = self.replay_buffer.sample(self.batch_size)
+                    actions.append(self.foxnet.available_actions.index(action_str))
+
+                # Send action to emulator, and remember it for the next iteration.
+                emulator.send_action(action_str)
+                emulator.last_action_str = action_str
+
+            # Get the next frames, the rewards (score + health) and whether the episodes ended (death or menu).
+            rewards = []
+            dones = []
+            for emulator in self.emulators:
+                emulator.read_frame()
+                reward, score_reward, done = emulator.get_reward()
+                rewards.append(reward)
+                dones.append(done)
+                max_score = max(score_reward, max_score)
+
+            # Store the <s,a,r,s'> transitions.
+            self.replay_buffer.store_effects(replay_buffer_indices, actions, rewards, dones)
+
+        return max_score
+
+    def warmed_up(self):
+        """Whether the replay buffer holds enough transitions to start training."""
+        return (self.replay_buffer.can_sample(self.batch_size) and
+                self.replay_buffer.num_in_buffer >= self.replay_warmup)
+
+    def can_train(self):
+        """Whether the learner may take its next training step without exceeding the replay ratio."""
+        return (self.warmed_up() and
+                self.grad_steps * self.env_steps_per_play < self.env_steps * self.train_steps_per_play)
+
+    def actor_may_play(self, slack):
+        """Whether the actor may play its next chunk of steps: always during warm-up, and afterwards as long as it is
+        at most `slack` environment steps ahead of the replay ratio."""
+        if not self.warmed_up():
+            return True
+        return (self.env_steps * self.train_steps_per_play <=
+                self.grad_steps * self.env_steps_per_play + slack * self.train_steps_per_play)
+
+    def q_values(self, states):
+        """Runs one batched inference for `states`, with the actor's copy of the network in actor/learner mode."""
+        if self.actor is not None:
+            feed_dict = {self.foxnet.actor_X: states}
+            return self.session.run(self.foxnet.actor_probs, feed_dict=feed_dict, options=self.inference_run_options)
+        feed_dict = {self.foxnet.X: states, self.foxnet.is_training: False}
+        return self.session.run(self.foxnet.probs, feed_dict=feed_dict, options=self.inference_run_options)
+
+    def update_priorities(self, td_errors):
+        """Sets the priorities of the last batch from its TD errors. Does nothing without prioritized replay."""
+        if self.batch_idxes is not None:
+            self.replay_buffer.update_priorities(self.batch_idxes, td_errors)
+
+    def save_snapshot(self, directory, learner_state):
+        """Saves what online training needs to resume besides the network: the replay buffer (incrementally, see
+        ReplayBuffer.save), epsilon, the step counters and `learner_state`, a JSON-serializable dict of the learner's
+        own counters."""
+        self.replay_buffer.save(os.path.join(directory, 'replay_buffer'))
+        state = dict(learner_state, epsilon=self.epsilon, env_steps=self.env_steps, grad_steps=self.grad_steps)
+        # Written last, so an interrupted snapshot leaves the previous state in place.
+        tmp_path = os.path.join(directory, 'data_manager.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, os.path.join(directory, 'data_manager.json'))
+
+    def load_snapshot(self, directory):
+        """Restores a snapshot written by save_snapshot. Returns False if `directory` holds none."""
+        state_path = os.path.join(directory, 'data_manager.json')
+        if not os.path.exists(state_path):
+            return False
+        with open(state_path) as f:
+            state = json.load(f)
+        self.replay_buffer.load(os.path.join(directory, 'replay_buffer'))
+        self.epsilon = state.pop('epsilon')
+        self.env_steps = state.pop('env_steps')
+        self.grad_steps = state.pop('grad_steps')
+        self.last_report = (time.time(), self.env_steps, self.grad_steps)
+        self.learner_state = state
+        print("Resumed from snapshot in %s: %d transitions, %d env steps, %d grad steps" %
+              (directory, self.replay_buffer.num_in_buffer, self.env_steps, self.grad_steps))
+        return True
+
+    def throughput_report(self):
+        """Environment steps/sec, gradient steps/sec and gradient steps per environment step since the last report."""
+        now, env_steps, grad_steps = time.time(), self.env_steps, self.grad_steps
+        last_time, last_env_steps, last_grad_steps = self.last_report
+        self.last_report = (now, env_steps, grad_steps)
+        elapsed = max(now - last_time, 1e-6)
+        replay_ratio = float(grad_steps - last_grad_steps) / max(env_steps - last_env_steps, 1)
+        return "env steps/sec = %.1f\tgrad steps/sec = %.2f\tgrad steps/env step = %.3f" % (
+            (env_steps - last_env_steps) / elapsed, (grad_steps - last_grad_steps) / elapsed, replay_ratio)
+
+    def replay_report(self):
+        """Replay buffer occupancy and RAM use, and sampling latency since the last report."""
+        num_in_buffer, size, nbytes = self.replay_buffer.footprint()
+        count, total, longest = self.sample_stats
+        self.sample_stats = [0, 0.0, 0.0]
+        return "replay buffer = %d/%d transitions\t%.1f MB\tsample ms = %.2f mean, %.2f max" % (
+            num_in_buffer, size, nbytes / 2.0**20, 1000.0 * total / max(count, 1), 1000.0 * longest)
+
+    def close(self):
+        if self.actor is not None:
+            self.actor.stop()
+        if self.prefetcher is not None:
+            # Wake up the replay prefetch thread, if it is waiting, so that it can stop.
+            self.replay_batch_taken.set()
+            self.prefetcher.close()
+
+    def close_stream(self):
+        """Stops the decode workers of the streamed dataset. Unlike close, this is only called after the final
+        validation, which still reads from the stream."""
+        if self.stream is not None:
+            self.stream.close()
+
+    def _sample_replay_batch(self):
+        start = time.time()
+        if self.prioritized_replay:
+            beta = min(1.0, self.priority_beta + (1.0 - self.priority_beta) * self.grad_steps / self.priority_beta_steps)
+            batch = self.replay_buffer.sample(self.batch_size, beta)
         else:
-            # Choose which data to batch
-            if (for_eval):
-                s_to_batch = self.s_eval
-                a_to_batch = self.a_eval
-                r_to_batch = None
-            else:
-                s_to_batch = self.s_train
-                a_to_batch = self.a_train
-                r_to_batch = self.r_train
-
-            # Generate indices for the batch.
-            start_idx = (self.batch_iteration * self.batch_size) % s_to_batch.shape[0]
-            idx = self.epoch_indices[start_idx: start_idx + self.batch_size]
-
-            s_batch = s_to_batch[idx, :]
-            a_batch = a_to_batch[idx]
-            if (not for_eval):
-                r_batch = r_to_batch[idx]
-
-        # print('Max score for current batch: %d' % max_score_batch)
-        return s_batch, a_batch, r_batch, max_score_batch
+            batch = self.replay_buffer.sample(self.batch_size)
+        elapsed = time.time() - start
+        count, total, longest = self.sample_stats
+        self.sample_stats = [count + 1, total + elapsed, max(longest, elapsed)]
+        return batch
+
+    def _sample_replay_batches(self):
+        # Runs in the prefetch thread. Each batch is sampled only once the previous one is handed out, i.e. while the
+        # training loop runs its train step on it, so a batch is one step stale: it misses the transitions played for
+        # the step it is used in and, with prioritized replay, the priority update of the previous step.
+        while True:
+            yield self._sample_replay_batch()
+            self.replay_batch_taken.wait()
+            self.replay_batch_taken.clear()
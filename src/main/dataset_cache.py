@@ -0,0 +1,88 @@
+# On-disk cache of decoded, resized recording directories
+
+import hashlib
+import json
+import numpy as np
+import os
+
+CACHE_VERSION = 2
+ARRAY_NAMES = ['frames', 'actions', 'scores', 'healths']
+
+
+class DatasetCache(object):
+    """Stores the decoded frames of each recording directory as .npy files that can be memory-mapped.
+
+    The cache lives in a subdirectory of `cache_dir` whose name is a hash of everything that changes the decoded
+    output: the data directory, the output height/width and the list of actions. Each recording directory gets its
+    own set of files, so adding a new recording only requires decoding that recording.
+
+    Layout of cache_dir/<key>/:
+        <dirname>.json            metadata (source filenames in frame-number order, number of frames)
+        <dirname>.frames.npy      uint8, (n, height, width, channels)
+        <dirname>.actions.npy     int64, (n,), index into the action list
+        <dirname>.scores.npy      int64, (n,)
+        <dirname>.healths.npy     int64, (n,)
+    """
+
+    def __init__(self, cache_dir, data_dir, height, width, actions):
+        key = {
+            "version": CACHE_VERSION,
+            "data_dir": os.path.abspath(data_dir),
+            "height": height,
+            "width": width,
+            "actions": list(actions),
+        }
+        digest = hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.root = os.path.join(cache_dir, digest)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+            with open(os.path.join(self.root, 'key.json'), 'w') as f:
+                json.dump(key, f, sort_keys=True, indent=2)
+
+    def _path(self, dirname, name, ext):
+        return os.path.join(self.root, '%s.%s%s' % (dirname, name, ext))
+
+    def _meta_path(self, dirname):
+        return os.path.join(self.root, dirname + '.json')
+
+    def load(self, dirname, filenames):
+        """Returns the cached arrays for `dirname` as a dict of read-only memmaps, or None if the directory has not
+        been cached or its contents changed since it was cached."""
+        meta_path = self._meta_path(dirname)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["filenames"] != [str(filename) for filename in filenames]:
+            return None
+        arrays = {}
+        for name in ARRAY_NAMES:
+            path = self._path(dirname, name, '.npy')
+            if not os.path.exists(path):
+                return None
+            arrays[name] = np.load(path, mmap_mode='r')
+        return arrays
+
+    def begin(self, dirname, frames_shape):
+        """Preallocates the frames file of a new entry so decoders can write into it directly. Returns the writable
+        memmap and its path; the entry only becomes visible to `load` once `commit` is called."""
+        path = self._path(dirname, 'frames', '.tmp.npy')
+        frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=frames_shape)
+        return frames, path
+
+    def commit(self, dirname, filenames, frames, actions, scores, healths):
+        """Finishes an entry started with `begin`. Files are written under a temporary name and renamed, so an
+        interrupted run never leaves a half-written entry behind."""
+        frames.flush()
+        del frames
+        os.rename(self._path(dirname, 'frames', '.tmp.npy'), self._path(dirname, 'frames', '.npy'))
+        for name, array in [('actions', actions), ('scores', scores), ('healths', healths)]:
+            tmp_path = self._path(dirname, name, '.tmp.npy')
+            np.save(tmp_path, array)
+            os.rename(tmp_path, self._path(dirname, name, '.npy'))
+        # The metadata is written last; an entry without metadata is treated as missing.
+        tmp_meta_path = self._meta_path(dirname) + '.tmp'
+        with open(tmp_meta_path, 'w') as f:
+            json.dump({"filenames": [str(filename) for filename in filenames], "num_frames": int(len(actions))}, f)
+        os.rename(tmp_meta_path, self._meta_path(dirname))
+        return self.load(dirname, filenames)
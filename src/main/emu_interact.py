@@ -9,7 +9,7 @@ import keylogger.keylogger as keylogger
 
 
 class FrameReader():
-	def __init__(self, ip, out_height, out_width):
+	def __init__(self, ip, out_height, out_width, port=11111):
 		self.WIDTH = 640
 		self.HEIGHT = 480
 		self.DEPTH = 3
@@ -19,6 +19,7 @@ class FrameReader():
 		self.out_height = out_height
 		self.out_width = out_width
 		self.ip = ip
+		self.port = port
 
 		self.actions = ['w', 'a', 's', 'd', 'j', 'k', 'n']
 
@@ -39,7 +40,7 @@ class FrameReader():
 			try:
 				# Use socket.gethostname() for local server
 				# Specify host IP for remote
-				self.s.connect((self.ip, 11111))
+				self.s.connect((self.ip, self.port))
 				print('Socket connected successfully')
 				break
 			except:
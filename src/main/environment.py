@@ -0,0 +1,78 @@
+from emu_interact import FrameReader
+from health.health import HealthExtractor
+from reward.knn_extract_reward_online import RewardExtractor
+from menu.menu_navigator import MenuNavigator
+import numpy as np
+
+
+def parse_emulators(emulators, default_ip):
+    """Parses a comma-separated list of host:port pairs. An empty list means a single emulator at default_ip on the
+    default port; a missing port also defaults to 11111."""
+    if not emulators:
+        return [(default_ip, 11111)]
+    addresses = []
+    for address in emulators.split(','):
+        host, _, port = address.strip().partition(':')
+        addresses.append((host or default_ip, int(port) if port else 11111))
+    return addresses
+
+
+class Emulator:
+    """One emulator connection, together with the per-game state needed to turn its frames into transitions: the last
+    frame read, the last action sent, whether the game is in a menu/video, and the extractors' previous score and
+    health."""
+
+    def __init__(self, ip, port, image_height, image_width, verbose=False):
+        self.verbose = verbose
+        self.frame_reader = FrameReader(ip, image_height, image_width, port)
+        self.health_extractor = HealthExtractor()
+        self.reward_extractor = RewardExtractor()
+        self.menu_navigator = MenuNavigator()
+
+        # Keep full image for reward extraction.
+        self.frame, self.full_image = self.frame_reader.read_frame()
+        self.last_action_str = 'n'
+        self.last_frame_was_a_menu = False
+
+        # Remember the health from the previous frame.
+        self.prev_health = None
+
+    def send_action(self, action_str):
+        self.frame_reader.send_action(action_str)
+
+    def read_frame(self):
+        self.frame, self.full_image = self.frame_reader.read_frame()
+
+    def skip_menus(self):
+        # As soon as the frame is the main menu, select the first option.
+        while self.menu_navigator.is_image_menu(self.full_image):
+            # Alternate actions between l and j because j selects the option, but holding j does nothing.
+            action_str = np.random.choice(['l', 'j'])
+            if self.verbose:
+                print('MENU DETECTED: Pressing l or j.'
+                      'Taking action: %s' % action_str)
+            self.send_action(action_str)
+            self.read_frame()
+
+    def get_reward(self):
+        """Extracts the reward (score + health) from the current full image. Returns (reward, score, done), where done
+        is True if the agent just died or the game just left the level for a menu/video, which ends the episode."""
+        score_reward, score_is_not_digits = self.reward_extractor.get_reward(self.full_image)
+        entered_menu = score_is_not_digits and not self.last_frame_was_a_menu
+        self.last_frame_was_a_menu = score_is_not_digits
+        health_reward = self.health_extractor(self.full_image, offline=False)
+
+        if self.verbose and not self.last_frame_was_a_menu:
+            print('Online reward extracted: score=%d\thealth=%f' % (score_reward, health_reward))
+
+        # Check if we just died.
+        died = False
+        if self.prev_health and self.prev_health > 0 and health_reward == 0:
+            # Agent just died.
+            if self.verbose:
+                print('Agent just died. Setting health reward to -10.')
+            health_reward = -10
+            died = True
+        self.prev_health = health_reward
+
+        return score_reward + health_reward, score_reward, died or entered_menu
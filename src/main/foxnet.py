@@ -1,14 +1,19 @@
+import numpy as np
 import tensorflow as tf
+from collections import namedtuple
 from functools import partial
 
 xavier = tf.contrib.layers.xavier_initializer
 
+def flatten(X):
+    """Reshapes X to (batch, features), with the number of features inferred from its static shape."""
+    return tf.reshape(X, [-1, X.get_shape()[1:].num_elements()])
+
 class FoxNet(object):
 
     def fully_connected(self, X, y, n_labels):
-        # Flatten: 48 x 64 x 3
-        flattened_size = 48 * 64 * 3
-        flattened = tf.reshape(X, [-1, flattened_size])
+        # Flatten: e.g. 48 x 64 x 3
+        flattened = flatten(X)
 
         # Fully connected layer
         affine_relu = tf.layers.dense(inputs=flattened, units=1024, activation=tf.nn.relu)
@@ -43,7 +48,7 @@ class FoxNet(object):
         conv2 = tf.layers.conv2d(
             inputs=norm1,
             filters=n_filters,
-            kernel_size=n_filters + 2,
+            kernel_size=filter_size,
             padding="same",
             activation=tf.nn.relu
         )
@@ -61,8 +66,7 @@ class FoxNet(object):
         pool = tf.layers.max_pooling2d(inputs=norm2, pool_size=[2, 2], strides=2)
 
         # Flatten
-        magic_number = 24576 # TODO: What should this number be?
-        flattened = tf.reshape(pool, [-1, magic_number])
+        flattened = flatten(pool)
 
         # # Affine + ReLU
         affine_relu = tf.layers.dense(inputs=flattened, units=1024, activation=tf.nn.relu)
@@ -102,8 +106,56 @@ class FoxNet(object):
                 activation = tf.nn.relu
             )
 
-            magic_number = 98304
-            conv3_flat = tf.reshape(conv3, [-1, magic_number])
+            # Flatten: (?, 48, 64, 32) to (?, 98304) for 48x64 inputs
+            conv3_flat = flatten(conv3)
+
+            affine_relu = tf.layers.dense(
+                inputs = conv3_flat,
+                units = 512,
+                activation = tf.nn.relu
+            )
+
+            y_out = tf.layers.dense(
+                inputs = affine_relu,
+                units = n_labels
+            )
+
+            return y_out
+
+    def DQN_strided(self, X, y, n_labels, scope):
+        # The convolutions of DeepMind's DQN: strides 4 and 2 shrink 48x64 inputs to a 6x8x64 map before the dense
+        # layer, which is ~1.6M parameters instead of ~50M for DQN.
+        input_layer = X
+
+        with tf.variable_scope(scope):
+            conv1 = tf.layers.conv2d(
+                inputs = input_layer,
+                filters = 32,
+                kernel_size = 8,
+                strides = 4,
+                padding = "same",
+                activation = tf.nn.relu
+            )
+
+            conv2 = tf.layers.conv2d(
+                inputs = conv1,
+                filters = 64,
+                kernel_size = 4,
+                strides = 2,
+                padding = "same",
+                activation = tf.nn.relu
+            )
+
+            conv3 = tf.layers.conv2d(
+                inputs = conv2,
+                filters = 64,
+                kernel_size = 3,
+                padding = "same",
+                activation = tf.nn.relu
+            )
+
+            # Flatten: (?, 6, 8, 64) to (?, 3072) for 48x64 inputs
+            conv3_flat = flatten(conv3)
 
             affine_relu = tf.layers.dense(
                 inputs = conv3_flat,
@@ -146,8 +198,7 @@ class FoxNet(object):
         )
 
         # Flatten: (?, 3, 48, 64, 32) to (?, 589824)
-        magic_number = frames_per_state * 98304
-        conv3_flat = tf.reshape(conv3, [-1, magic_number])
+        conv3_flat = flatten(conv3)
 
         affine_relu = tf.layers.dense(
             inputs = conv3_flat,
@@ -161,3 +212,75 @@ class FoxNet(object):
         )
 
         return y_out
+
+
+# Architectures selectable with --model. `build(foxnet, X, n_labels, config)` returns the logits/Q-values of the
+# network on X, where config is a dict of the hyperparameters some of them use: is_training, dropout,
+# cnn_filter_size, cnn_n_filters and frames_per_state. Multi-frame architectures take states of shape
+# (frames, height, width, channels) instead of (height, width, channels).
+Architecture = namedtuple('Architecture', ['build', 'multi_frame'])
+ARCHITECTURES = {}
+
+def register(name, multi_frame=False):
+    def decorator(build):
+        ARCHITECTURES[name] = Architecture(build, multi_frame)
+        return build
+    return decorator
+
+def get_architecture(name):
+    if name not in ARCHITECTURES:
+        raise ValueError("Invalid model specified. Valid options are: %s" % ", ".join(sorted(ARCHITECTURES)))
+    return ARCHITECTURES[name]
+
+@register("fc")
+def _build_fc(foxnet, X, n_labels, config):
+    return foxnet.fully_connected(X, None, n_labels)
+
+@register("simple_cnn")
+def _build_simple_cnn(foxnet, X, n_labels, config):
+    return foxnet.simple_cnn(X, None, config["cnn_filter_size"], config["cnn_n_filters"], config["dropout"], n_labels,
+                             config["is_training"])
+
+@register("dqn")
+def _build_dqn(foxnet, X, n_labels, config):
+    return foxnet.DQN(X, None, n_labels, scope="q")
+
+@register("dqn_strided")
+def _build_dqn_strided(foxnet, X, n_labels, config):
+    return foxnet.DQN_strided(X, None, n_labels, scope="q")
+
+@register("dqn_3d", multi_frame=True)
+def _build_dqn_3d(foxnet, X, n_labels, config):
+    return foxnet.DQN_3D(X, None, n_labels, config["frames_per_state"])
+
+
+# Ops whose outputs count as activations; elementwise ops fused into them (bias, ReLU) are not counted separately.
+ACTIVATION_OPS = ['Conv2D', 'Conv3D', 'MatMul', 'MaxPool', 'MaxPool3D', 'FusedBatchNorm', 'FusedBatchNormV2']
+
+def network_cost(ops, variables):
+    """Cost per sample of the network made of `ops` and `variables`. Returns (parameters, FLOPs, activation bytes),
+    counting a multiply-add as two FLOPs and only convolutions and matrix multiplications as FLOPs, with float32
+    activations. Needs static shapes for everything but the batch dimension. Only one branch of every tf.cond counts,
+    since only one of them runs (e.g. batch normalization with a tensor training flag builds both)."""
+    parameters = sum(v.get_shape().num_elements() for v in variables)
+    flops = 0
+    activations = 0
+    cond_ops = set()
+    for op in ops:
+        if op.type not in ACTIVATION_OPS:
+            continue
+        if '/cond/' in op.name:
+            # Ops of both branches share the cond's scope; count the first op of each type.
+            key = (op.name.rsplit('/cond/', 1)[0], op.type)
+            if key in cond_ops:
+                continue
+            cond_ops.add(key)
+        output_shape = op.outputs[0].get_shape()[1:]
+        if op.type in ['Conv2D', 'Conv3D']:
+            # Kernel: (spatial..., in channels, out channels); the output holds out channels per position.
+            kernel_shape = op.inputs[1].get_shape().as_list()
+            flops += 2 * output_shape.num_elements() * int(np.prod(kernel_shape[:-1]))
+        elif op.type == 'MatMul':
+            flops += 2 * op.inputs[1].get_shape().num_elements()
+        activations += 4 * output_shape.num_elements()
+    return parameters, flops, activations
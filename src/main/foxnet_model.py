@@ -1,8 +1,9 @@
 # Tensorflow model declarations
 
 import datetime
-from foxnet import FoxNet
+from foxnet import FoxNet, get_architecture, network_cost
 import numpy as np
+import os
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 from tqdm import *
@@ -37,7 +38,10 @@ class FoxNetModel(object):
                 available_actions_names,
                 cnn_filter_size,
                 cnn_n_filters,
-                verbose = False):
+                verbose = False,
+                uint8_input = False,
+                actor_network = False,
+                n_step = 1):
 
         self.lr = lr
         self.reg_lambda = reg_lambda
@@ -49,34 +53,60 @@ class FoxNetModel(object):
         self.available_actions_names = available_actions_names
         self.num_actions = len(self.available_actions)
         self.q_learning = q_learning
+        self.gamma = 0.99
+        self.n_step = n_step
 
         # Placeholders
         # The first dim is None, and gets sets automatically based on batch size fed in
         # count (in train/test set) x 480 (height) x 680 (width) x 3 (channels) x 3 (num frames)
-        if model == "dqn_3d":
-            self.X = ph(tf.float32, [None, frames_per_state, height, width, n_channels])
+        # With uint8_input, frames are fed as uint8 (a quarter of the bytes of float32) and converted to floats in
+        # [0, 1] by the first op of the graph.
+        input_dtype = tf.uint8 if uint8_input else tf.float32
+        if get_architecture(model).multi_frame:
+            self.X = ph(input_dtype, [None, frames_per_state, height, width, n_channels])
         else:
-            self.X = ph(tf.float32, [None, height, width, n_channels])
+            self.X = ph(input_dtype, [None, height, width, n_channels])
         self.y = ph(tf.int64, [None])
         self.is_training = ph(tf.bool)
 
+        self.uint8_input = uint8_input
+
         foxnet = FoxNet()
 
         # Build net
-        if model == "fc":
-            self.probs = foxnet.fully_connected(self.X, self.y, self.num_actions)
-        elif model == "simple_cnn":
-            self.probs = foxnet.simple_cnn(self.X, self.y, cnn_filter_size, cnn_n_filters, dropout, self.num_actions, self.is_training)
-        elif model == "dqn":
-            self.probs = foxnet.DQN(self.X, self.y, self.num_actions, scope="q")
-        elif model == "dqn_3d":
-            self.probs = foxnet.DQN_3D(self.X, self.y, self.num_actions, frames_per_state)
-        else:
-            raise ValueError("Invalid model specified. Valid options are: 'fcc', 'simple_cnn', 'dqn', 'dqn_3d'")
+        variables_before = set(tf.global_variables())
+        num_ops_before = len(tf.get_default_graph().get_operations())
+        self.probs = self.build_network(foxnet, model, self.X, self.is_training, dropout, frames_per_state,
+                                        cnn_filter_size, cnn_n_filters)
+        network_variables = [v for v in tf.global_variables() if v not in variables_before]
+
+        # Report the cost of the network per sample.
+        network_ops = tf.get_default_graph().get_operations()[num_ops_before:]
+        parameters, flops, activation_bytes = network_cost(network_ops, [v for v in network_variables
+                                                                         if v in tf.trainable_variables()])
+        print("Model %s: %.2fM parameters, %.1f MFLOPs per sample, %.2f MB of activations per sample" %
+              (model, parameters / 1e6, flops / 1e6, activation_bytes / 2.0**20))
+
+        if q_learning:
+            # The states n_step steps after those in X, for the Q-learning targets; an empty batch when not fed. Their
+            # Q-values come from a second pass in inference mode over the same variables, so the targets get no
+            # dropout and the next states never enter the batch-norm statistics.
+            x_shape = self.X.get_shape().as_list()
+            self.next_X = tf.placeholder_with_default(tf.zeros([0] + x_shape[1:], dtype=input_dtype), x_shape,
+                                                      name='next_X')
+            with tf.variable_scope("next_q", custom_getter=_shared_getter(network_variables)):
+                next_q_values = self.build_network(foxnet, model, self.next_X, False, dropout, frames_per_state,
+                                                   cnn_filter_size, cnn_n_filters)
+            self.next_q_values = tf.stop_gradient(next_q_values)
+
+        # Metrics against the labels in y, built once and reused by every batch.
+        self.predictions = tf.argmax(self.probs, 1)
+        self.correct_prediction = tf.equal(self.predictions, self.y)
+        self.accuracy = tf.reduce_mean(tf.cast(self.correct_prediction, tf.float32))
 
         # Set up loss for Q-learning
         if q_learning:
-            gamma = 0.99
+            gamma = self.gamma
             self.rewards = ph(tf.float32, [None], name='rewards')
             self.q_values = self.probs
             self.actions = ph(tf.uint8, [None], name='action')
@@ -86,9 +116,19 @@ class FoxNetModel(object):
                 self.add_q_learning_update_target_op("q", "target_q")
                 self.add_q_learning_loss_op(self.q_values, self.target_q_values)
             else:
-                Q_samp = self.rewards + gamma * tf.reduce_max(self.q_values, axis=1)
+                # 1 where the episode ended before next_X.
+                self.done_mask = tf.placeholder_with_default(tf.zeros_like(self.rewards), [None], name='done_mask')
+                # Bootstrap from the n-step next states when they are fed (online), else from the current states.
+                next_max_q = lambda: tf.reduce_max(self.next_q_values, axis=1)
+                bootstrap = tf.cond(tf.shape(self.next_X)[0] > 0,
+                                    lambda: gamma ** n_step * (1 - self.done_mask) * next_max_q(),
+                                    lambda: gamma * tf.reduce_max(self.q_values, axis=1))
+                Q_samp = self.rewards + bootstrap
                 action_mask = tf.one_hot(indices=self.actions, depth=self.num_actions)
-                self.loss = tf.reduce_sum(tf.square((Q_samp-tf.reduce_sum(self.q_values*action_mask, axis=1))))
+                self.td_errors = Q_samp - tf.reduce_sum(self.q_values*action_mask, axis=1)
+                # Importance-sampling weights of a prioritized replay batch. All ones unless fed.
+                self.is_weights = tf.placeholder_with_default(tf.ones_like(self.rewards), [None], name='is_weights')
+                self.loss = tf.reduce_sum(self.is_weights * tf.square(self.td_errors))
 
         # Otherwise, set up loss for classification.
         else:
@@ -108,6 +148,31 @@ class FoxNetModel(object):
         optimizer = tf.train.AdamOptimizer(self.lr) # Select optimizer and set learning rate
         self.train_step = optimizer.minimize(self.loss)
 
+        # Second copy of the network for an actor thread that plays while the learner trains. Its weights are only
+        # changed by sync_actor_op, which copies the learner's; they are not trainable, so the loss and optimizer
+        # above never touch them.
+        if actor_network:
+            self.actor_X = ph(self.X.dtype, self.X.get_shape())
+            with tf.variable_scope("actor", custom_getter=_non_trainable_getter):
+                self.actor_probs = self.build_network(foxnet, model, self.actor_X, False, dropout, frames_per_state,
+                                                      cnn_filter_size, cnn_n_filters)
+            actor_variables = [v for v in tf.global_variables() if v.name.startswith("actor/")]
+            self.sync_actor_op = tf.group(*[tf.assign(actor_var, var)
+                                            for actor_var, var in zip(actor_variables, network_variables)])
+
+    def build_network(self, foxnet, model, X, is_training, dropout, frames_per_state, cnn_filter_size, cnn_n_filters):
+        if self.uint8_input:
+            X = tf.cast(X, tf.float32) * (1.0 / 255)
+
+        config = {
+            "is_training": is_training,
+            "dropout": dropout,
+            "cnn_filter_size": cnn_filter_size,
+            "cnn_n_filters": cnn_n_filters,
+            "frames_per_state": frames_per_state,
+        }
+        return get_architecture(model).build(foxnet, X, self.num_actions, config)
+
 
     def add_q_learning_update_target_op(self, q_scope, target_q_scope):
         source_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=q_scope)
@@ -157,15 +222,9 @@ class FoxNetModel(object):
             while data_manager.has_next_batch():
                 s_batch, a_batch, _, _ = data_manager.get_next_batch()
 
-                # Have tensorflow compute accuracy.
-                # TODO BUG: When using batches, seems to compare arrs of size (batch_size,) and (total_size,)
-                correct_prediction = tf.equal(tf.argmax(self.probs, 1), a_batch)
-                accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
-                # batch_size = yd.shape[0] # TODO: Add back batch sizes
-
                 # Setting up variables we want to compute (and optimizing)
                 # If we have a training function, add that to things we compute
-                variables = [self.loss, correct_prediction, accuracy]
+                variables = [self.loss, self.correct_prediction, self.accuracy]
                 if training_now:
                     variables[-1] = self.train_step
 
@@ -192,8 +251,8 @@ class FoxNetModel(object):
                           .format(iter_cnt, loss, np.sum(corr) * 1.0 / actual_batch_size))
                 iter_cnt += 1
 
-            total_correct = correct * 1.0 / data_manager.s_train.shape[0]
-            total_loss = np.sum(losses) / data_manager.s_train.shape[0]
+            total_correct = correct * 1.0 / data_manager.num_examples()
+            total_loss = np.sum(losses) / data_manager.num_examples()
             epoch_losses.append(total_loss)
             epoch_accuracies.append(total_correct)
             print("Epoch {2}, Overall training loss = {0:.3g} and accuracy of {1:.3g}"
@@ -241,21 +300,21 @@ class FoxNetModel(object):
         total_correct = 0
         losses = []
 
+        # Confusion matrix accumulated batch by batch: rows are actual actions, columns predicted ones.
         if confusion:
-            confusion_predictions = []
-            confusion_labels = []
+            confusion_matrix = np.zeros((self.num_actions, self.num_actions), dtype=np.int64)
 
         data_manager.init_epoch(for_eval=True)
         while data_manager.has_next_batch(for_eval=True):
             s_batch, a_batch, r_batch, _ = data_manager.get_next_batch(for_eval=True)
             batch_size = s_batch.shape[0]
 
-            correct_validation = tf.equal(tf.argmax(self.probs, 1), a_batch)
-            variables = [self.loss, self.probs, correct_validation]
+            variables = [self.loss, self.predictions, self.correct_prediction]
 
             if self.q_learning:
                 feed_dict = {
                     self.X: s_batch,
+                    self.y: a_batch,
                     self.rewards: r_batch,
                     self.actions: a_batch,
                     self.is_training: False
@@ -267,30 +326,25 @@ class FoxNetModel(object):
                     self.is_training: False
                 }
 
-            loss, probs, correct = session.run(variables, feed_dict=feed_dict)
+            loss, predictions, correct = session.run(variables, feed_dict=feed_dict)
 
             losses.append(loss * batch_size)
             total_correct += np.sum(correct)
 
             if confusion:
-                predictions = tf.cast(tf.argmax(probs, 1), tf.int32)
-                confusion_predictions.append(predictions)
-                confusion_labels.append(tf.cast(a_batch, tf.int32))
+                cells = np.asarray(a_batch, dtype=np.int64) * self.num_actions + predictions
+                confusion_matrix += np.bincount(cells, minlength=self.num_actions ** 2).reshape(confusion_matrix.shape)
 
-        accuracy = total_correct * 1.0 / data_manager.s_eval.shape[0]
-        total_loss = np.sum(losses) / data_manager.s_eval.shape[0]
+        accuracy = total_correct * 1.0 / data_manager.num_examples(for_eval=True)
+        total_loss = np.sum(losses) / data_manager.num_examples(for_eval=True)
 
         if print_results:
             print("Validation loss = \t{0:.3g}\nValidation accuracy = \t{1:.3g}".format(total_loss, accuracy))
 
         if confusion:
             print("Generating confusion matrix:")
-            confusion_labels = tf.concat(confusion_labels, 0)
-            confusion_predictions = tf.concat(confusion_predictions, 0)
-            confusion_matrix = tf.confusion_matrix(confusion_labels, confusion_predictions, num_classes = len(self.available_actions))
-            with session.as_default():
-                confusion_matrix = confusion_matrix.eval()
-                print(confusion_matrix)
+            print(confusion_matrix)
+            print(format_precision_recall(confusion_matrix, self.available_actions_names))
             make_confusion_matrix(confusion_matrix, self.available_actions_names, results_dir, dt)
 
         return total_loss, accuracy
@@ -306,13 +360,16 @@ class FoxNetModel(object):
                        dt="",
                        plot=False,
                        plot_every=1,
+                       snapshot_dir=None,
+                       snapshot_every=1000,
                        ):
 
         losses = []
         scores = []
         xlabels = []
 
-        total_batch_count = 0
+        # Resume the batch count of the snapshot the data manager was restored from, if any.
+        total_batch_count = data_manager.learner_state.get('total_batch_count', 0)
         for e in range(epochs):
             data_manager.init_epoch()
             batch_count = 0
@@ -323,23 +380,40 @@ class FoxNetModel(object):
                 batch_reward = sum(r_batch)
                 actual_batch_size = data_manager.batch_size
 
-                variables = [self.loss, self.train_step]
+                variables = [self.loss, self.train_step, self.td_errors]
                 feed_dict = {
                     self.X: s_batch,
                     self.rewards: r_batch,
                     self.actions: a_batch,
                     self.is_training: training_now}
-                loss, _ = session.run(variables, feed_dict=feed_dict)
+                if data_manager.batch_next_states is not None:
+                    feed_dict[self.next_X] = data_manager.batch_next_states
+                    feed_dict[self.done_mask] = data_manager.batch_done_mask
+                if data_manager.batch_weights is not None:
+                    feed_dict[self.is_weights] = data_manager.batch_weights
+                loss, _, td_errors = session.run(variables, feed_dict=feed_dict)
+                data_manager.update_priorities(td_errors)
 
                 print("loss: ", loss)
                 print("batch reward: ", batch_reward)
 
+                if data_manager.is_online and total_batch_count % 100 == 0:
+                    print(data_manager.throughput_report())
+
                 if save_model and total_batch_count % 100 == 0:
                     print("-- saving model --")
+                    if data_manager.is_online:
+                        print(data_manager.replay_report())
                     self.saver.save(session, model_path)
                     # Anneal epsilon
                     data_manager.epsilon *= 0.9
 
+                # Snapshot the network, optimizer slots, replay buffer and counters to resume from after a restart.
+                if snapshot_dir and total_batch_count % snapshot_every == 0:
+                    print("-- saving snapshot --")
+                    self.snapshot_saver.save(session, os.path.join(snapshot_dir, 'model'))
+                    data_manager.save_snapshot(snapshot_dir, {'total_batch_count': total_batch_count + 1})
+
                 # Plot loss every "plot_every" batches (overwrites prev plot)
                 print('total_batch_count=%d\tplot_every=%d' % (total_batch_count, plot_every))
                 if plot and total_batch_count % plot_every == 0:
@@ -353,9 +427,29 @@ class FoxNetModel(object):
                 batch_count += 1
                 total_batch_count += 1
 
+def _non_trainable_getter(getter, *args, **kwargs):
+    kwargs['trainable'] = False
+    return getter(*args, **kwargs)
+
+def _shared_getter(variables):
+    """Custom getter that returns the variable of `variables` with the same name, minus the outermost scope, instead
+    of creating a new one."""
+    variables_by_name = dict((v.op.name, v) for v in variables)
+    def shared_getter(getter, name, *args, **kwargs):
+        return variables_by_name[name.split('/', 1)[1]]
+    return shared_getter
+
 def format_list(list):
     return "["+", ".join(["%.2f" % x for x in list])+"]"
 
+def format_precision_recall(conf_arr, names):
+    """Per-class precision and recall from a confusion matrix whose rows are actual classes."""
+    true_positives = np.diag(conf_arr).astype(np.float64)
+    precision = true_positives / np.maximum(conf_arr.sum(axis=0), 1)
+    recall = true_positives / np.maximum(conf_arr.sum(axis=1), 1)
+    return "\n".join("%-12s precision = %.3f\trecall = %.3f" % (name, p, r)
+                     for name, p, r in zip(names, precision, recall))
+
 def make_classification_plot(plot_name, train, validate_incrementally, validate, results_dir, dt):
     train_line = plt.plot(train, label="Training " + plot_name)
     if validate_incrementally:
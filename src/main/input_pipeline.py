@@ -0,0 +1,204 @@
+# Streaming input pipeline for offline training on recordings larger than memory
+
+from collections import deque
+from functools import partial
+import multiprocessing
+import numpy as np
+import os
+import threading
+import traceback
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from data import select_frames, decode_image
+from dataset_cache import DatasetCache
+
+
+class BackgroundPrefetcher(object):
+    """Runs a generator in a daemon thread and keeps up to `capacity` of its items ready in a bounded queue, so that
+    producing the next item overlaps with whatever the consumer is doing (e.g. session.run)."""
+
+    _END = object()
+
+    def __init__(self, generator, capacity):
+        self.queue = queue.Queue(maxsize=capacity)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, args=(generator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, generator):
+        try:
+            for item in generator:
+                if not self._put(item):
+                    return
+        except Exception:
+            self._put(_PrefetchError(traceback.format_exc()))
+            return
+        self._put(self._END)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        """Returns the next item, or None once the generator is exhausted. Errors in the generator are re-raised."""
+        if self.finished:
+            return None
+        item = self.queue.get()
+        if item is self._END:
+            self.finished = True
+            return None
+        if isinstance(item, _PrefetchError):
+            self.finished = True
+            raise RuntimeError("Error in prefetch thread:\n" + item.traceback)
+        return item
+
+    def close(self):
+        """Stops the producer thread, discarding any items it has prepared."""
+        self.stopped.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.finished = True
+
+
+class _PrefetchError(object):
+    def __init__(self, traceback):
+        self.traceback = traceback
+
+
+def shuffle_buffer(items, buffer_size, rng):
+    """Approximately shuffles an iterable while holding at most `buffer_size` items in memory."""
+    buf = []
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        j = rng.randint(buffer_size)
+        yield buf[j]
+        buf[j] = item
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def batch_examples(examples, batch_size):
+    """Groups (state, action, reward) examples into contiguous (s_batch, a_batch, r_batch) arrays."""
+    batch = []
+    for example in examples:
+        batch.append(example)
+        if len(batch) == batch_size:
+            yield _stack(batch)
+            batch = []
+    if batch:
+        yield _stack(batch)
+
+
+def _stack(batch):
+    states, actions, rewards = zip(*batch)
+    return np.stack(states), np.array(actions, dtype=np.int64), np.array(rewards, dtype=np.int64)
+
+
+def in_eval_set(dirname, frame_numbers, eval_proportion):
+    """Deterministically assigns frames to the eval set by hashing their directory and frame number, so the split is
+    stable across runs without having to load the whole dataset first."""
+    buckets = np.array([zlib.crc32(('%s/%d' % (dirname, frame)).encode('utf-8')) & 0xffffffff
+                        for frame in frame_numbers], dtype=np.int64) % 10000
+    return buckets < int(eval_proportion * 10000)
+
+
+class StreamingDataset(object):
+    """Offline dataset that is read recording by recording instead of being loaded into memory.
+
+    Frames come from the DatasetCache if a recording has already been cached (params['cache_dir']) and are decoded
+    from the PNGs otherwise, with a pool of params['num_workers'] processes if more than one. Memory use is bounded by
+    the shuffle buffer and the prefetch queue, independently of the dataset size.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.selection = select_frames(params)
+        self.frames_per_state = params["frames_per_state"] if params["multi_frame_state"] else 1
+        self.cache = None
+        if params.get("cache_dir"):
+            self.cache = DatasetCache(params["cache_dir"], params["data_dir"], params["height"], params["width"],
+                                      params["actions"])
+        self.pool = None
+        if params.get("num_workers", 1) > 1:
+            self.pool = multiprocessing.Pool(params["num_workers"])
+
+        # Which selected frames are usable states, and whether they belong to the eval set.
+        self.masks = []
+        for dirname, rows, positions in self.selection:
+            has_history = np.arange(len(positions)) >= self.frames_per_state - 1
+            is_eval = in_eval_set(dirname, rows['frame'][positions], params["eval_proportion"])
+            self.masks.append((has_history & ~is_eval, has_history & is_eval))
+
+    def num_examples(self, for_eval=False):
+        return int(sum(np.sum(masks[int(for_eval)]) for masks in self.masks))
+
+    def _frames(self, dirname, rows, positions):
+        entry = self.cache.load(dirname, rows['filename']) if self.cache is not None else None
+        if entry is not None:
+            for position in positions:
+                yield entry['frames'][position]
+            return
+        paths = [os.path.join(self.params["data_dir"], dirname, filename) for filename in rows['filename'][positions]]
+        decode = partial(decode_image, params=self.params)
+        if self.pool is not None:
+            for frame in self.pool.imap(decode, paths, chunksize=16):
+                yield frame
+        else:
+            for path in paths:
+                yield decode(path)
+
+    def examples(self, for_eval=False, rng=None):
+        """Yields (state, action, reward) for every example of the train (or eval) set. Recordings are visited in a
+        random order when `rng` is given; frames within a recording are read sequentially."""
+        order = np.arange(len(self.selection))
+        if rng is not None:
+            rng.shuffle(order)
+        for i in order:
+            dirname, rows, positions = self.selection[i]
+            wanted = self.masks[i][int(for_eval)]
+            if self.frames_per_state == 1:
+                # No history needed, so frames outside of this set are never decoded.
+                positions = positions[wanted]
+                wanted = np.ones(len(positions), dtype=bool)
+            actions = [self.params["actions"].index(a) for a in rows['action'][positions]]
+            rewards = rows['score'][positions] + rows['health'][positions]
+
+            history = deque(maxlen=self.frames_per_state)
+            for k, frame in enumerate(self._frames(dirname, rows, positions)):
+                history.append(frame)
+                if wanted[k]:
+                    state = frame if self.frames_per_state == 1 else np.stack(history)
+                    yield state, actions[k], rewards[k]
+
+    def batches(self, batch_size, for_eval=False, shuffle_buffer_size=0, seed=None):
+        """Yields (s_batch, a_batch, r_batch) for one pass over the train (or eval) set. Training batches are drawn
+        through a shuffle buffer of `shuffle_buffer_size` examples."""
+        if for_eval or shuffle_buffer_size <= 1:
+            examples = self.examples(for_eval)
+        else:
+            rng = np.random.RandomState(seed)
+            examples = shuffle_buffer(self.examples(for_eval, rng), shuffle_buffer_size, rng)
+        return batch_examples(examples, batch_size)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
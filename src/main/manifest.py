@@ -0,0 +1,97 @@
+# Index of the frames in each recording directory, built from filenames alone
+
+import hashlib
+import numpy as np
+import os
+import re
+
+# Matching group 1 is frame number, matching group 2 is action
+pattern = re.compile('i=(\d+)_a=(\w)(_s=(\d+)_h=(\d+))?.png')
+
+FIELDS = ['filename', 'frame', 'action', 'score', 'health', 'size']
+
+
+def parse_filename(filename):
+    """Returns (frame number, action, score, health) encoded in a frame's filename, or None if it is not a frame."""
+    match = re.search(pattern, filename)
+    if match is None:
+        return None
+    score = 0
+    health = 0
+    if match.group(3) is not None:
+        score = int(match.group(4))
+        health = int(match.group(5))
+    return int(match.group(1)), match.group(2), score, health
+
+
+def manifest_dir(manifests_root, data_dir):
+    """Where the recording manifests of `data_dir` are kept under `manifests_root`, or None to build them in memory on
+    every run."""
+    if not manifests_root:
+        return None
+    digest = hashlib.md5(os.path.abspath(data_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(manifests_root, digest)
+
+
+class Manifest(object):
+    """Per-directory index of recorded frames: filename, frame number, action, score, health and file size.
+
+    Manifests are saved as <manifest_dir>/<dirname>.npz and updated incrementally: if the directory has not been
+    modified since the manifest was written it is used as is, otherwise only filenames that are new since then are
+    parsed and stat'ed. Rows are always ordered by frame number. With manifest_dir=None nothing is saved.
+    """
+
+    def __init__(self, data_dir, manifest_dir=None):
+        self.data_dir = data_dir
+        self.manifest_dir = manifest_dir
+        if manifest_dir is not None and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+
+    def _manifest_path(self, dirname):
+        return os.path.join(self.manifest_dir, dirname + '.npz')
+
+    def _load_saved(self, dirname):
+        if self.manifest_dir is None or not os.path.exists(self._manifest_path(dirname)):
+            return None
+        saved = np.load(self._manifest_path(dirname))
+        rows = dict((field, saved[field]) for field in FIELDS)
+        return rows, float(saved['mtime'])
+
+    def load(self, dirname):
+        """Returns the rows of `dirname` as a dict of equal-length numpy arrays keyed by FIELDS."""
+        dir_path = os.path.join(self.data_dir, dirname)
+        mtime = os.path.getmtime(dir_path)
+        saved = self._load_saved(dirname)
+        if saved is not None and saved[1] == mtime:
+            return saved[0]
+
+        filenames = set(os.listdir(dir_path))
+        known = {}
+        if saved is not None:
+            rows = saved[0]
+            for i, filename in enumerate(rows['filename']):
+                if filename in filenames:
+                    known[filename] = tuple(rows[field][i] for field in FIELDS)
+
+        entries = list(known.values())
+        for filename in filenames.difference(known):
+            parsed = parse_filename(filename)
+            if parsed is None:
+                continue
+            size = os.path.getsize(os.path.join(dir_path, filename))
+            entries.append((filename,) + parsed + (size,))
+        entries.sort(key=lambda entry: entry[1])
+
+        rows = {
+            'filename': np.array([e[0] for e in entries], dtype=np.str_),
+            'frame': np.array([e[1] for e in entries], dtype=np.int64),
+            'action': np.array([e[2] for e in entries], dtype=np.str_),
+            'score': np.array([e[3] for e in entries], dtype=np.int64),
+            'health': np.array([e[4] for e in entries], dtype=np.int64),
+            'size': np.array([e[5] for e in entries], dtype=np.int64),
+        }
+        if self.manifest_dir is not None:
+            tmp_path = self._manifest_path(dirname) + '.tmp.npz'
+            np.savez(tmp_path, mtime=mtime, **rows)
+            os.rename(tmp_path, self._manifest_path(dirname))
+        return rows
@@ -1,22 +1,168 @@
+import ctypes
+import hashlib
+import json
+import multiprocessing
 import numpy as np
-import random
+import os
+import tempfile
+import threading
+import zlib
 
-def sample_n_unique(sampling_f, n):
-    """Helper function. Given a function `sampling_f` that returns
-    comparable objects, sample n such unique objects.
+def sample_n_unique(high, n):
+    """Helper function. Sample n unique integers from [0, high) in random
+    order. Draws with replacement and tops up after removing duplicates,
+    which only takes a few vectorized rounds when n is much smaller than
+    high; otherwise takes a prefix of a permutation.
     """
-    res = []
+    assert n <= high
+    if 4 * n >= high:
+        return np.random.permutation(high)[:n]
+    res = np.unique(np.random.randint(0, high, n))
     while len(res) < n:
-        candidate = sampling_f()
-        if candidate not in res:
-            res.append(candidate)
-    return res
+        res = np.unique(np.concatenate([res, np.random.randint(0, high, n - len(res))]))
+    return np.random.permutation(res)
+
+class SumTree(object):
+    """Array-based binary tree over `capacity` non-negative leaf values,
+    in which every internal node holds the sum of its two children.
+
+    Node 1 is the root and the children of node i are 2i and 2i + 1; the
+    leaves are nodes [num_leaves, 2 * num_leaves), with num_leaves the
+    capacity rounded up to a power of two. Updating leaves and finding the
+    leaf at a given prefix sum both take O(log capacity), and both are
+    vectorized over a batch of leaves.
+    """
+    def __init__(self, capacity):
+        self.num_leaves = 1
+        while self.num_leaves < capacity:
+            self.num_leaves *= 2
+        self.nodes = np.zeros(2 * self.num_leaves, dtype=np.float64)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, idxes):
+        return self.nodes[self.num_leaves + np.asarray(idxes)]
+
+    def update(self, idxes, values):
+        """Sets leaves `idxes` to `values` and recomputes their ancestors."""
+        nodes = self.num_leaves + np.asarray(idxes)
+        self.nodes[nodes] = values
+        nodes = np.unique(nodes // 2)
+        # All nodes are on the same level; stop after the root.
+        while len(nodes) > 0 and nodes[0] >= 1:
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """For every value in [0, total), returns the leaf i such that the
+        sum of the leaves before i is <= value < that sum plus leaf i.
+        Leaves with a value of 0 are never returned (unless all are 0)."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while self.num_leaves > 1 and nodes[0] < self.num_leaves:
+            left = 2 * nodes
+            left_sum = self.nodes[left]
+            # Never descend into an empty subtree, even if rounding errors push a value past the end of the left one.
+            go_right = (values >= left_sum) & (self.nodes[left + 1] > 0)
+            values = np.where(go_right, values - left_sum, values)
+            nodes = left + go_right
+        return nodes - self.num_leaves
+
+class CompressedFrames(object):
+    """Drop-in replacement for the frame array of a ReplayBuffer that
+    stores every distinct frame once, compressed with zlib.
+
+    Frames are identified by a hash of their contents, so the long runs of
+    identical frames in menus, cutscenes and pauses take the space of one
+    frame, and each distinct frame is kept alive by a reference count of
+    the buffer indices holding it. Indexing with an integer array or a
+    slice decompresses each distinct frame of the whole batch once.
+    Indices that were never written read as zeros.
+    """
+    def __init__(self, shape, level=1):
+        self.shape = tuple(shape)
+        self.level = level
+        self.digests = [None] * self.shape[0]
+        self.blobs = {}
+        self.refcounts = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the compressed frames."""
+        return sum(len(blob) for blob in self.blobs.values())
+
+    def _indices(self, key):
+        # Only the indices in the key, since an arange over the whole buffer would cost O(size) per access.
+        if isinstance(key, slice):
+            return np.arange(*key.indices(self.shape[0]))
+        return np.asarray(key)
+
+    def __setitem__(self, key, frames):
+        idxes = self._indices(key)
+        if idxes.ndim == 0:
+            self._store(int(idxes), frames)
+        else:
+            for idx, frame in zip(idxes, frames):
+                self._store(idx, frame)
+
+    def _store(self, idx, frame):
+        data = np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+        digest = hashlib.sha1(data).digest()
+        if digest == self.digests[idx]:
+            return
+        self._release(idx)
+        if digest in self.blobs:
+            self.refcounts[digest] += 1
+        else:
+            self.blobs[digest] = zlib.compress(data, self.level)
+            self.refcounts[digest] = 1
+        self.digests[idx] = digest
+
+    def _release(self, idx):
+        digest = self.digests[idx]
+        if digest is None:
+            return
+        self.refcounts[digest] -= 1
+        if self.refcounts[digest] == 0:
+            del self.refcounts[digest]
+            del self.blobs[digest]
+        self.digests[idx] = None
+
+    def __getitem__(self, key):
+        idxes = self._indices(key)
+        unique_idxes, inverse = np.unique(idxes, return_inverse=True)
+        frames = np.zeros((len(unique_idxes),) + self.shape[1:], dtype=np.uint8)
+        # Decompress each distinct frame once, even if several indices hold it.
+        decompressed = {}
+        for i, idx in enumerate(unique_idxes):
+            digest = self.digests[idx]
+            if digest is None:
+                continue
+            if digest not in decompressed:
+                decompressed[digest] = np.frombuffer(zlib.decompress(self.blobs[digest]), dtype=np.uint8)
+            frames[i] = decompressed[digest].reshape(self.shape[1:])
+        return frames[inverse.reshape(idxes.shape)]
+
+def _save_npz(path, arrays):
+    """Writes `arrays` under a temporary name and renames it, so a snapshot never holds a half-written file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
 
 class ReplayBuffer(object):
     """
     Taken from Berkeley's Assignment
     """
-    def __init__(self, size, frame_history_len):
+    # Transitions per file in a snapshot. Only chunks modified since the previous snapshot are rewritten.
+    snapshot_chunk_size = 8192
+
+    def __init__(self, size, frame_history_len, num_envs=1, history_layout='channels', obs_dir=None,
+                 compress_frames=False, n_step=1, gamma=0.99, frame_shape=None):
         """This is a memory efficient implementation of the replay buffer.
 
         The sepecific memory optimizations use here are:
@@ -34,6 +180,17 @@ class ReplayBuffer(object):
         of the episode, when there is less frames than `frame_history_len`,
         is acceptable.
 
+        All public methods hold `self.lock`, so a background thread can
+        `sample` while another thread stores frames and effects. The most
+        recently stored frame is never sampled as an observation: its effect
+        may not have been stored yet, and its next frame does not exist yet.
+
+        Experience from `num_envs` environments stepped in lockstep is
+        interleaved: every step stores one frame per environment with
+        `store_frames`, so the frames of environment e occupy the indices
+        congruent to e modulo num_envs, and frame histories and next
+        observations are read with a stride of num_envs.
+
         Parameters
         ----------
         size: int
@@ -41,33 +198,127 @@ class ReplayBuffer(object):
             overflows the old memories are dropped.
         frame_history_len: int
             Number of memories to be retried for each observation.
+        num_envs: int
+            Number of environments whose frames are interleaved in the buffer.
+            `size` is rounded down to a multiple of it.
+        history_layout: str
+            'channels' to stack the frames of an observation along the
+            channel axis, (img_h, img_w, img_c * frame_history_len), or
+            'frames' to stack them along a new leading axis,
+            (frame_history_len, img_h, img_w, img_c), as dqn_3d expects.
+        obs_dir: str
+            If given, frames are kept in a memory-mapped temporary file in
+            this directory instead of in RAM, so the capacity is bounded by
+            disk space. Actions, rewards and done flags stay in RAM. The file
+            is deleted when the buffer is garbage collected.
+        compress_frames: bool
+            If True, frames are kept in a CompressedFrames store, which keeps
+            one zlib-compressed copy of every distinct frame. Cannot be
+            combined with obs_dir.
+        n_step: int
+            Number of steps of the returns sampled: the reward of a sampled
+            transition is the discounted sum of the rewards of the next
+            n_step transitions of its environment (stopping at the end of
+            the episode), and its next observation is the one n_step steps
+            later. The n_step most recent frames of every environment are
+            not sampled.
+        gamma: float
+            Discount of the n-step returns.
+        frame_shape: tuple
+            If given, the buffer is allocated and written once here, so that
+            running out of memory (or disk space, with obs_dir) fails at
+            startup rather than on the first store_frame. Otherwise it is
+            allocated by the first store_frame.
         """
-        self.size = size
+        self.num_envs = num_envs
+        self.n_step = n_step
+        self.gamma = gamma
+        self.size = max(size - size % num_envs, num_envs)
         self.frame_history_len = frame_history_len
+        self.history_layout = history_layout
+        # Offsets of the frames of an observation from its most recent frame.
+        self.history_offsets = num_envs * np.arange(1 - frame_history_len, 1)
 
         self.next_idx      = 0
         self.num_in_buffer = 0
+        # Most recent frames whose effects are not stored yet; snapshots leave them out.
+        self.num_pending_effects = 0
 
         self.obs      = None
         self.action   = None
         self.reward   = None
         self.done     = None
 
+        assert obs_dir is None or not compress_frames, "obs_dir and compress_frames are exclusive"
+        self.obs_dir  = obs_dir
+        self.obs_file = None
+        self.compress_frames = compress_frames
+
+        # Chunks modified since the last snapshot, and the directory it was written to.
+        self.dirty_chunks = None
+        self.snapshot_dir = None
+
+        # Most recent observation of every environment, updated as frames are stored, for acting. An environment
+        # whose last effect ended an episode starts from zeros at its next frame.
+        self.recent_obs   = None
+        self.recent_reset = np.zeros(num_envs, dtype=np.bool)
+
+        self.lock = threading.RLock()
+
+        if frame_shape is not None:
+            self._allocate(frame_shape, validate=True)
+
+    @classmethod
+    def bytes_per_transition(cls, frame_shape, frames_in_ram=True):
+        """Bytes of RAM used per transition by a buffer of frames of shape
+        `frame_shape`; frames do not count if they are kept on disk."""
+        frame_bytes = int(np.prod(frame_shape)) if frames_in_ram else 0
+        # uint8 frame, int32 action, float32 reward, bool done.
+        return frame_bytes + 4 + 4 + 1
+
+    @classmethod
+    def size_for_budget(cls, budget_bytes, frame_shape, frames_in_ram=True):
+        """Number of transitions that fit in `budget_bytes` of RAM."""
+        return int(budget_bytes // cls.bytes_per_transition(frame_shape, frames_in_ram))
+
+    @property
+    def nbytes(self):
+        """Bytes of RAM held by the stored transitions."""
+        if self.obs is None:
+            return 0
+        total = self.action.nbytes + self.reward.nbytes + self.done.nbytes
+        if self.obs_file is None:
+            total += self.obs.nbytes
+        return total
+
+    def footprint(self):
+        """Returns (transitions stored, capacity, bytes of RAM used)."""
+        with self.lock:
+            return self.num_in_buffer, self.size, self.nbytes
+
     def can_sample(self, batch_size):
         """Returns true if `batch_size` different transitions can be sampled from the buffer."""
-        return batch_size + 1 <= self.num_in_buffer
+        return batch_size + self.n_step * self.num_envs <= self.num_in_buffer
 
-    def _encode_sample(self, idxes):
-        obs_batch      = np.concatenate([self._encode_observation(idx)[None] for idx in idxes], 0)
+    def _encode_sample(self, idxes, need_next_obs=True):
+        # The n_step transitions of each sampled one's environment, starting with it.
+        steps          = (idxes[:, None] + self.num_envs * np.arange(self.n_step)) % self.size
+        rewards        = self.reward[steps]
+        dones          = self.done[steps]
+        # Rewards after the end of an episode do not count towards the return.
+        in_episode     = (np.cumsum(dones, axis=1) - dones) == 0
+        obs_batch      = self._encode_observations(idxes)
         act_batch      = self.action[idxes]
-        rew_batch      = self.reward[idxes]
-        next_obs_batch = np.concatenate([self._encode_observation(idx + 1)[None] for idx in idxes], 0)
-        done_mask      = np.array([1.0 if self.done[idx] else 0.0 for idx in idxes], dtype=np.float32)
+        rew_batch      = np.sum(rewards * in_episode * self.gamma ** np.arange(self.n_step), axis=1).astype(np.float32)
+        next_obs_batch = None
+        if need_next_obs:
+            next_obs_batch = self._encode_observations((idxes + self.n_step * self.num_envs) % self.size)
+        done_mask      = np.any(dones, axis=1).astype(np.float32)
 
         return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
 
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, need_next_obs=True):
         """Sample `batch_size` different transitions.
 
         i-th sample transition is the following:
@@ -78,17 +329,25 @@ class ReplayBuffer(object):
         was done which is represented by `done_mask[i]` which is equal
         to 1 if episode has ended as a result of that action.
 
+        With n_step > 1, `rew_batch[i]` is the discounted return of the
+        next n_step transitions, `next_obs_batch[i]` the observation
+        n_step steps later, and `done_mask[i]` is 1 if the episode ended
+        within those steps.
+
         Parameters
         ----------
         batch_size: int
             How many transitions to sample.
+        need_next_obs: bool
+            If False, next observations are not encoded and next_obs_batch
+            is None.
 
         Returns
         -------
         obs_batch: np.array
             Array of shape
             (batch_size, img_h, img_w, img_c * frame_history_len)
-            and dtype np.uint8
+            and dtype np.uint8 (see `history_layout`)
         act_batch: np.array
             Array of shape (batch_size,) and dtype np.int32
         rew_batch: np.array
@@ -100,9 +359,12 @@ class ReplayBuffer(object):
         done_mask: np.array
             Array of shape (batch_size,) and dtype np.float32
         """
-        assert self.can_sample(batch_size)
-        idxes = sample_n_unique(lambda: random.randint(0, self.num_in_buffer - 2), batch_size)
-        return self._encode_sample(idxes)
+        with self.lock:
+            assert self.can_sample(batch_size)
+            # Offsets from the oldest stored frame, excluding the n_step most recent ones of each environment.
+            oldest_idx = self.next_idx - self.num_in_buffer
+            offsets = sample_n_unique(self.num_in_buffer - self.n_step * self.num_envs, batch_size)
+            return self._encode_sample((oldest_idx + offsets) % self.size, need_next_obs)
 
     def encode_recent_observation(self):
         """Return the most recent `frame_history_len` frames.
@@ -113,35 +375,79 @@ class ReplayBuffer(object):
             Array of shape (img_h, img_w, img_c * frame_history_len)
             and dtype np.uint8, where observation[:, :, i*img_c:(i+1)*img_c]
             encodes frame at time `t - frame_history_len + i`
+            (see `history_layout`)
         """
-        assert self.num_in_buffer > 0
-        return self._encode_observation((self.next_idx - 1) % self.size)
-
-    def _encode_observation(self, idx):
-        end_idx   = idx + 1 # make noninclusive
-        start_idx = end_idx - self.frame_history_len
-        # this checks if we are using low-dimensional observations, such as RAM
-        # state, in which case we just directly return the latest RAM.
-        # if len(self.obs.shape) <= 2:
-        #     return self.obs[end_idx-1]
-        # if there weren't enough frames ever in the buffer for context
-        if start_idx < 0 and self.num_in_buffer != self.size:
-            start_idx = 0
-        for idx in range(start_idx, end_idx - 1):
-            if self.done[idx % self.size]:
-                start_idx = idx + 1
-        missing_context = self.frame_history_len - (end_idx - start_idx)
-        # if zero padding is needed for missing context
-        # or we are on the boundry of the buffer
-        if start_idx < 0 or missing_context > 0:
-            frames = [np.zeros_like(self.obs[0]) for _ in range(missing_context)]
-            for idx in range(start_idx, end_idx):
-                frames.append(self.obs[idx % self.size])
-            return np.concatenate(frames, 2)
+        with self.lock:
+            assert self.num_in_buffer > 0
+            return self.recent_obs[(self.next_idx - 1) % self.num_envs].copy()
+
+    def encode_recent_observations(self):
+        """Return the most recent observation of every environment, as an
+        array of shape (num_envs, img_h, img_w, img_c * frame_history_len).
+
+        Observations are kept up to date by store_frame, one frame at a
+        time, so this is a single contiguous copy."""
+        with self.lock:
+            assert self.num_in_buffer >= self.num_envs
+            return self.recent_obs.copy()
+
+    def _push_recent(self, idx, frame):
+        """Shifts `frame` into the most recent observation of its environment."""
+        if self.recent_obs is None:
+            img_h, img_w, img_c = frame.shape
+            if self.history_layout == 'frames':
+                shape = (self.num_envs, self.frame_history_len, img_h, img_w, img_c)
+            else:
+                shape = (self.num_envs, img_h, img_w, self.frame_history_len * img_c)
+            self.recent_obs = np.zeros(shape, dtype=np.uint8)
+        env = idx % self.num_envs
+        stack = self.recent_obs[env]
+        if self.recent_reset[env]:
+            stack[...] = 0
+            self.recent_reset[env] = False
+        if self.history_layout == 'frames':
+            stack[:-1] = stack[1:]
+            stack[-1] = frame
+        else:
+            img_c = frame.shape[-1]
+            stack[..., :-img_c] = stack[..., img_c:]
+            stack[..., -img_c:] = frame
+
+    def _encode_observations(self, idxes):
+        """Gathers the frame histories ending at `idxes` with a single fancy
+        index. Frames from before the start of an episode, or older than
+        the oldest frame in the buffer, are replaced by zeros."""
+        positions, valid = self._history_positions(idxes)
+
+        # A frame is dropped if an episode ended at it or at any later frame
+        # of the history (the most recent frame itself does not count).
+        done = self.done[positions[:, :-1]] & valid[:, :-1]
+        ended_later = np.cumsum(done[:, ::-1], axis=1)[:, ::-1] > 0
+        valid[:, :-1] &= ~ended_later
+
+        if self.obs_file is None:
+            frames = self.obs[positions]
         else:
-            # this optimization has potential to saves about 30% compute time \o/
-            img_h, img_w = self.obs.shape[1], self.obs.shape[2]
-            return self.obs[start_idx:end_idx].transpose(1, 2, 0, 3).reshape(img_h, img_w, -1)
+            # Read every distinct frame once, in file order, so the page cache sees mostly sequential reads.
+            unique_positions, inverse = np.unique(positions, return_inverse=True)
+            frames = self.obs[unique_positions][inverse.reshape(positions.shape)]
+        frames[~valid] = 0
+        if self.history_layout == 'frames':
+            return frames
+        # (batch, history, h, w, c) -> (batch, h, w, history * c)
+        n, _, img_h, img_w, _ = frames.shape
+        return frames.transpose(0, 2, 3, 1, 4).reshape(n, img_h, img_w, -1)
+
+    def _history_positions(self, idxes):
+        """Buffer indices of the frame histories ending at `idxes`, of shape
+        (len(idxes), frame_history_len), and whether each of them holds a
+        frame that is still in the buffer."""
+        # Positions of the history frames relative to the oldest stored frame.
+        oldest_idx = self.next_idx - self.num_in_buffer
+        relative = ((idxes - oldest_idx) % self.size)[:, None] + self.history_offsets
+        valid = relative >= 0
+        positions = (relative + oldest_idx) % self.size
+        return positions, valid
 
     def store_frame(self, frame):
         """Store a single frame in the buffer at the next available index, overwriting
@@ -158,18 +464,62 @@ class ReplayBuffer(object):
         idx: int
             Index at which the frame is stored. To be used for `store_effect` later.
         """
-        if self.obs is None:
-            self.obs      = np.empty([self.size] + list(frame.shape), dtype=np.uint8)
+        with self.lock:
+            if self.obs is None:
+                self._allocate(frame.shape)
+            self.obs[self.next_idx] = frame
+            self.dirty_chunks[self.next_idx // self.snapshot_chunk_size] = True
+            self._push_recent(self.next_idx, frame)
+
+            ret = self.next_idx
+            self.next_idx = (self.next_idx + 1) % self.size
+            self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
+            self.num_pending_effects = min(self.num_pending_effects + 1, self.num_in_buffer)
+
+            return ret
+
+    def _allocate(self, frame_shape, validate=False):
+        obs_shape = [self.size] + list(frame_shape)
+        if validate and self.obs_dir is not None:
+            stat = os.statvfs(self.obs_dir)
+            if stat.f_bavail * stat.f_frsize < np.prod(obs_shape):
+                raise IOError("Not enough space in %s for %d replay buffer frames of shape %s" %
+                              (self.obs_dir, self.size, tuple(frame_shape)))
+        try:
+            self.obs      = self._allocate_obs(obs_shape)
             self.action   = np.empty([self.size],                     dtype=np.int32)
             self.reward   = np.empty([self.size],                     dtype=np.float32)
             self.done     = np.empty([self.size],                     dtype=np.bool)
-        self.obs[self.next_idx] = frame
+            if validate:
+                # Write every page now; the OS only commits memory when it is first written.
+                for array in [self.obs, self.action, self.reward, self.done]:
+                    if type(array) is np.ndarray:
+                        array.fill(0)
+        except MemoryError:
+            self.obs = None
+            raise MemoryError("Cannot allocate a replay buffer of %d transitions (%.1f MB)" %
+                              (self.size, self.size * self.bytes_per_transition(frame_shape) / 2.0**20))
+        # Chunks only become dirty when a transition is written to them.
+        self.dirty_chunks = np.zeros(self._num_chunks(), dtype=np.bool)
+
+    def _allocate_obs(self, shape):
+        if self.compress_frames:
+            return CompressedFrames(shape)
+        if self.obs_dir is None:
+            return np.empty(shape, dtype=np.uint8)
+        self.obs_file = tempfile.NamedTemporaryFile(dir=self.obs_dir, prefix='replay_obs_', suffix='.dat')
+        return np.memmap(self.obs_file, dtype=np.uint8, mode='w+', shape=tuple(shape))
 
-        ret = self.next_idx
-        self.next_idx = (self.next_idx + 1) % self.size
-        self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
+    def store_frames(self, frames):
+        """Store one frame per environment, in environment order. Returns
+        the indices at which they were stored, for `store_effects`."""
+        assert len(frames) == self.num_envs
+        return [self.store_frame(frame) for frame in frames]
 
-        return ret
+    def store_effects(self, idxes, actions, rewards, dones):
+        """Store the effects of one step of every environment."""
+        for idx, action, reward, done in zip(idxes, actions, rewards, dones):
+            self.store_effect(idx, action, reward, done)
 
     def store_effect(self, idx, action, reward, done):
         """Store effects of action taken after obeserving frame stored
@@ -188,6 +538,393 @@ class ReplayBuffer(object):
         done: bool
             True if episode was finished after performing that action.
         """
+        with self.lock:
+            self.action[idx] = action
+            self.reward[idx] = reward
+            self.done[idx]   = done
+            self.dirty_chunks[idx // self.snapshot_chunk_size] = True
+            self.num_pending_effects = max(self.num_pending_effects - 1, 0)
+            if done:
+                self.recent_reset[idx % self.num_envs] = True
+
+    def _num_chunks(self):
+        return (self.size + self.snapshot_chunk_size - 1) // self.snapshot_chunk_size
+
+    def _chunk_path(self, directory, chunk):
+        return os.path.join(directory, 'chunk_%d.npz' % chunk)
+
+    def _snapshot_state(self):
+        """Arrays besides the transitions that a snapshot must hold. Called with the lock held."""
+        return {}
+
+    def _restore_state(self, arrays):
+        pass
+
+    def save(self, directory):
+        """Writes a snapshot of the buffer to `directory`, which is reused by later snapshots.
+
+        The buffer is split into chunks of `snapshot_chunk_size` transitions, one .npz file each, and only the
+        chunks that hold transitions and were modified since the previous snapshot to the same directory are
+        written. Chunks are copied and written one at a time, and the lock is only held while one chunk is copied,
+        so other threads can keep storing frames during the snapshot and at most one chunk is duplicated in memory.
+
+        meta.json records the buffer as it was when the snapshot started, without the most recent frames whose
+        effects were not stored yet, and is written last. Transitions stored during the snapshot may already be in
+        the chunk files (in place of the oldest transitions meta.json records); they are written again by the next
+        snapshot.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.lock:
+            if self.obs is None:
+                return
+            if self.snapshot_dir != directory:
+                self.dirty_chunks[:] = True
+            state = self._snapshot_state()
+            meta = {
+                'size': self.size,
+                'num_envs': self.num_envs,
+                'frame_shape': list(self.obs.shape[1:]),
+                'next_idx': (self.next_idx - self.num_pending_effects) % self.size,
+                'num_in_buffer': self.num_in_buffer - self.num_pending_effects,
+            }
+            # Indices from num_in_buffer on have never been written.
+            num_written_chunks = (meta['num_in_buffer'] + self.snapshot_chunk_size - 1) // self.snapshot_chunk_size
+            chunks = np.flatnonzero(self.dirty_chunks[:num_written_chunks])
+        i = 0
+        try:
+            for i, chunk in enumerate(chunks):
+                start = chunk * self.snapshot_chunk_size
+                end = min(start + self.snapshot_chunk_size, self.size)
+                with self.lock:
+                    self.dirty_chunks[chunk] = False
+                    arrays = {
+                        'obs': np.array(self.obs[start:end]),
+                        'action': self.action[start:end].copy(),
+                        'reward': self.reward[start:end].copy(),
+                        'done': self.done[start:end].copy(),
+                    }
+                _save_npz(self._chunk_path(directory, chunk), arrays)
+                del arrays
+            _save_npz(os.path.join(directory, 'state.npz'), state)
+            tmp_meta_path = os.path.join(directory, 'meta.json.tmp')
+            with open(tmp_meta_path, 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_meta_path, os.path.join(directory, 'meta.json'))
+        except Exception:
+            with self.lock:
+                self.dirty_chunks[chunks[i:]] = True
+            raise
+        self.snapshot_dir = directory
+
+    def load(self, directory):
+        """Replaces the contents of the buffer with the snapshot in `directory`. Returns False if there is none.
+
+        The emulators restart after a resume, so the most recent transition of every environment is marked as the end
+        of its episode, and the next frames start new observations."""
+        meta_path = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['size'] != self.size or meta['num_envs'] != self.num_envs:
+            raise ValueError("Replay buffer snapshot in %s has size %d and %d environments, expected %d and %d" %
+                             (directory, meta['size'], meta['num_envs'], self.size, self.num_envs))
+        with self.lock:
+            # Reuse the arrays allocated up front, if any, instead of holding two buffers at once.
+            if self.obs is None or list(self.obs.shape[1:]) != meta['frame_shape']:
+                self._allocate(meta['frame_shape'])
+            for chunk in range(self._num_chunks()):
+                path = self._chunk_path(directory, chunk)
+                if not os.path.exists(path):
+                    # Never filled before the snapshot.
+                    continue
+                start = chunk * self.snapshot_chunk_size
+                with np.load(path) as arrays:
+                    end = start + len(arrays['action'])
+                    self.obs[start:end]    = arrays['obs']
+                    self.action[start:end] = arrays['action']
+                    self.reward[start:end] = arrays['reward']
+                    self.done[start:end]   = arrays['done']
+            with np.load(os.path.join(directory, 'state.npz')) as arrays:
+                self._restore_state(arrays)
+            self.next_idx      = meta['next_idx']
+            self.num_in_buffer = meta['num_in_buffer']
+            self.num_pending_effects = 0
+            self.dirty_chunks  = np.zeros(self._num_chunks(), dtype=np.bool)
+            self.snapshot_dir  = directory
+            self.recent_obs    = None
+            self.recent_reset[:] = True
+            num_recent = min(self.num_envs, self.num_in_buffer)
+            recent_idxes = (self.next_idx - num_recent + np.arange(num_recent)) % self.size
+            self.done[recent_idxes] = True
+            self.dirty_chunks[recent_idxes // self.snapshot_chunk_size] = True
+        return True
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer that samples transitions in proportion to a priority,
+    as in Schaul et al., "Prioritized Experience Replay" (proportional
+    variant).
+
+    Priorities live in a SumTree with one leaf per buffer index, so
+    sampling a batch and updating its priorities take O(batch_size * log
+    size). New transitions get the highest priority seen so far, so each
+    is likely to be sampled at least once; afterwards the learner sets
+    their priority from their TD error with `update_priorities`. The most
+    recent n_step frames of every environment have priority 0, which keeps
+    them from being sampled like in ReplayBuffer.
+
+    Frames and effects are stored with the same store_frame/store_effect
+    API as ReplayBuffer.
+    """
+    def __init__(self, size, frame_history_len, alpha, num_envs=1, history_layout='channels', eps=1e-6,
+                 obs_dir=None, compress_frames=False, n_step=1, gamma=0.99, frame_shape=None):
+        """
+        Parameters
+        ----------
+        alpha: float
+            How much prioritization is used, from 0 (uniform sampling) to 1
+            (sampling proportional to the TD error).
+        eps: float
+            Added to the absolute TD errors so that no transition ends up
+            with priority 0.
+        """
+        super(PrioritizedReplayBuffer, self).__init__(size, frame_history_len, num_envs, history_layout, obs_dir,
+                                                      compress_frames, n_step, gamma, frame_shape)
+        self.alpha = alpha
+        self.eps = eps
+        self.tree = SumTree(self.size)
+        self.max_priority = 1.0
+
+    @classmethod
+    def bytes_per_transition(cls, frame_shape, frames_in_ram=True):
+        # Plus the sum-tree: two float64 nodes per leaf, with up to twice as many leaves as transitions.
+        return super(PrioritizedReplayBuffer, cls).bytes_per_transition(frame_shape, frames_in_ram) + 32
+
+    @property
+    def nbytes(self):
+        return super(PrioritizedReplayBuffer, self).nbytes + self.tree.nodes.nbytes
+
+    def store_frame(self, frame):
+        with self.lock:
+            idx = super(PrioritizedReplayBuffer, self).store_frame(frame)
+            # The frame n_step frames back in this environment now has its n-step return, and can be sampled.
+            self.tree.update([idx], [0.0])
+            if self.num_in_buffer > self.n_step * self.num_envs:
+                self.tree.update([(idx - self.n_step * self.num_envs) % self.size], [self.max_priority])
+            return idx
+
+    def sample(self, batch_size, beta, need_next_obs=True):
+        """Sample `batch_size` transitions with probability proportional
+        to their priority.
+
+        Parameters
+        ----------
+        batch_size: int
+            How many transitions to sample.
+        beta: float
+            How much the importance-sampling weights correct for the
+            non-uniform sampling, from 0 (no correction) to 1 (full).
+        need_next_obs: bool
+            See ReplayBuffer.sample.
+
+        Returns
+        -------
+        obs_batch, act_batch, rew_batch, next_obs_batch, done_mask:
+            See ReplayBuffer.sample.
+        weights: np.array
+            Array of shape (batch_size,) and dtype np.float32, the
+            importance-sampling weight of each transition, scaled so that
+            the largest weight in the batch is 1.
+        idxes: np.array
+            Array of shape (batch_size,), the buffer indices of the
+            transitions, to be passed to `update_priorities`.
+        """
+        with self.lock:
+            assert self.can_sample(batch_size)
+            # Stratified sampling: one transition from each of batch_size equal segments of the total priority.
+            total = self.tree.total()
+            values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (total / batch_size)
+            idxes = self.tree.find(values)
+            # w_i = (N * P(i)) ** -beta; N cancels out once the weights are scaled by their maximum.
+            weights = (self.tree.get(idxes) / total) ** -beta
+            weights /= weights.max()
+            return self._encode_sample(idxes, need_next_obs) + (weights.astype(np.float32), idxes)
+
+    def _snapshot_state(self):
+        return {'tree': self.tree.nodes.copy(), 'max_priority': np.array(self.max_priority)}
+
+    def _restore_state(self, arrays):
+        self.tree.nodes[:] = arrays['tree']
+        self.max_priority = float(arrays['max_priority'])
+
+    def update_priorities(self, idxes, td_errors):
+        """Sets the priorities of the transitions at `idxes` (as returned by
+        `sample`) from their TD errors."""
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        with self.lock:
+            # Transitions overwritten since they were sampled may be among the most recent ones, which must keep
+            # priority 0.
+            live = self.tree.get(idxes) > 0
+            self.tree.update(idxes[live], priorities[live])
+            self.max_priority = max(self.max_priority, priorities.max())
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """Replay buffer whose frames, actions, rewards and done flags live in
+    shared memory, so that actor processes forked from (or passed) the
+    buffer write their experience straight into the arrays the learner
+    samples from, without pickling frames through a pipe.
+
+    Each environment is driven by a single actor, which claims its
+    environment index with `claim_env` and passes it to store_frame and
+    encode_recent_observation. As in ReplayBuffer, environment e owns the
+    indices congruent to e modulo num_envs, but every environment has its
+    own frame counter, so actors do not have to run in lockstep. An actor
+    is the only writer of its slots and its counter, and publishes a frame
+    by incrementing its counter after writing it, so storing frames takes
+    no lock.
+
+    Since actors keep writing while the learner samples, the oldest
+    `reserve` frames of every environment are never read: an actor can
+    store that many frames during one `sample` before it overwrites a
+    frame being read.
+
+    Frames must have the shape given to the constructor, since the shared
+    arrays are allocated before any frame is stored. n_step and gamma work
+    as in ReplayBuffer. Prioritized sampling and snapshots are not
+    supported.
+    """
+    def __init__(self, size, frame_history_len, frame_shape, num_envs=1, history_layout='channels', reserve=64,
+                 n_step=1, gamma=0.99):
+        self.raw_env_counts = None
+        super(SharedReplayBuffer, self).__init__(size, frame_history_len, num_envs, history_layout,
+                                                 n_step=n_step, gamma=gamma)
+        self.frame_shape = tuple(frame_shape)
+        self.capacity_per_env = self.size // num_envs
+        self.reserve = reserve
+        assert self.capacity_per_env > reserve + frame_history_len + n_step, "Buffer too small for the reserve"
+
+        self.raw_obs    = multiprocessing.RawArray('B', int(self.size * np.prod(self.frame_shape)))
+        self.raw_action = multiprocessing.RawArray('i', self.size)
+        self.raw_reward = multiprocessing.RawArray('f', self.size)
+        self.raw_done   = multiprocessing.RawArray('b', self.size)
+        # Frames stored so far by each environment, and the number of environments claimed by an actor.
+        self.raw_env_counts = multiprocessing.RawArray(ctypes.c_int64, num_envs)
+        self.envs_claimed = multiprocessing.Value('i', 0)
+        self._map_arrays()
+
+    def _map_arrays(self):
+        self.obs          = np.frombuffer(self.raw_obs, dtype=np.uint8).reshape((self.size,) + self.frame_shape)
+        self.action       = np.frombuffer(self.raw_action, dtype=np.int32)
+        self.reward       = np.frombuffer(self.raw_reward, dtype=np.float32)
+        self.done         = np.frombuffer(self.raw_done, dtype=np.bool)
+        self.env_counts   = np.frombuffer(self.raw_env_counts, dtype=np.int64)
+        self.dirty_chunks = np.zeros(self._num_chunks(), dtype=np.bool)
+
+    def __getstate__(self):
+        # Pickled to start a process: send the shared arrays, and remap them on the other side.
+        state = self.__dict__.copy()
+        for name in ['obs', 'action', 'reward', 'done', 'env_counts', 'dirty_chunks', 'lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self._map_arrays()
+
+    @property
+    def num_in_buffer(self):
+        """Frames that can still be read, over all environments."""
+        if self.raw_env_counts is None:
+            return 0
+        counts = self.env_counts.copy()
+        return int((counts - self._oldest_readable(counts)).sum())
+
+    @num_in_buffer.setter
+    def num_in_buffer(self, value):
+        # Derived from the per-environment counters; ReplayBuffer.__init__ resets it before they exist.
+        pass
+
+    def claim_env(self):
+        """Returns the index of an environment no other actor has claimed."""
+        with self.envs_claimed.get_lock():
+            env = self.envs_claimed.value
+            assert env < self.num_envs, "All %d environments are already claimed" % self.num_envs
+            self.envs_claimed.value += 1
+        return env
+
+    def _oldest_readable(self, counts):
+        # Oldest frame of each environment that is not about to be overwritten.
+        return np.maximum(counts - self.capacity_per_env + self.reserve, 0)
+
+    def _num_sampleable(self, counts):
+        # Every readable frame but the n_step most recent ones of its environment.
+        return np.maximum(counts - self.n_step - self._oldest_readable(counts), 0)
+
+    def can_sample(self, batch_size):
+        return batch_size <= self._num_sampleable(self.env_counts.copy()).sum()
+
+    def sample(self, batch_size, need_next_obs=True):
+        """See ReplayBuffer.sample. Transitions are sampled uniformly over
+        all environments."""
+        counts = self.env_counts.copy()
+        sampleable = self._num_sampleable(counts)
+        assert batch_size <= sampleable.sum()
+        offsets = sample_n_unique(sampleable.sum(), batch_size)
+        # Environment of each offset, and the frame number within that environment.
+        ends = np.cumsum(sampleable)
+        envs = np.searchsorted(ends, offsets, side='right')
+        frames = self._oldest_readable(counts)[envs] + offsets - (ends - sampleable)[envs]
+        return self._encode_sample((frames * self.num_envs + envs) % self.size, need_next_obs)
+
+    def _history_positions(self, idxes):
+        counts = self.env_counts.copy()
+        envs = idxes % self.num_envs
+        # Frame number of each index: the most recent one stored in its slot.
+        slots = idxes // self.num_envs
+        latest = counts[envs] - 1
+        frames = latest - (latest - slots) % self.capacity_per_env
+        oldest = self._oldest_readable(counts)[envs, None]
+        valid = (frames[:, None] + np.arange(1 - self.frame_history_len, 1)) >= oldest
+        positions = (idxes[:, None] + self.history_offsets) % self.size
+        return positions, valid
+
+    def store_frame(self, frame, env=0):
+        """Stores the next frame of environment `env`. Only the actor that
+        claimed `env` may call this."""
+        count = self.env_counts[env]
+        idx = (count * self.num_envs + env) % self.size
+        self.obs[idx] = frame
+        # Publish the frame only once it is written.
+        self.env_counts[env] = count + 1
+        return idx
+
+    def store_frames(self, frames):
+        assert len(frames) == self.num_envs
+        return [self.store_frame(frame, env) for env, frame in enumerate(frames)]
+
+    def store_effect(self, idx, action, reward, done):
+        # The transition cannot be sampled before the next frame of its environment is published.
         self.action[idx] = action
         self.reward[idx] = reward
-        self.done[idx]   = done
\ No newline at end of file
+        self.done[idx]   = done
+
+    def encode_recent_observation(self, env=0):
+        """Return the most recent observation of environment `env`."""
+        assert self.env_counts[env] > 0
+        idx = ((self.env_counts[env] - 1) * self.num_envs + env) % self.size
+        return self._encode_observations(np.array([idx]))[0]
+
+    def encode_recent_observations(self):
+        counts = self.env_counts.copy()
+        assert np.all(counts > 0)
+        envs = np.arange(self.num_envs)
+        return self._encode_observations(((counts - 1) * self.num_envs + envs) % self.size)
+
+    def save(self, directory):
+        raise NotImplementedError("SharedReplayBuffer does not support snapshots")
+
+    def load(self, directory):
+        raise NotImplementedError("SharedReplayBuffer does not support snapshots")
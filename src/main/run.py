@@ -1,22 +1,28 @@
+import ctypes
+import ctypes.util
 import datetime
 import json
+import multiprocessing
 import numpy as np
 import os
 import sys
 import tensorflow as tf
 
+from foxnet import ARCHITECTURES, get_architecture
 from foxnet_model import FoxNetModel
 from data_manager import DataManager
+from environment import parse_emulators
 from scipy.misc import imresize
 
 
 # COMMAND LINE ARGUMENTS
 tf.app.flags.DEFINE_bool("dev", False, "")
 tf.app.flags.DEFINE_bool("test", False, "")
-tf.app.flags.DEFINE_string("model", "fc", "Options: fc, simple_cnn, dqn, dqn_3d")
+tf.app.flags.DEFINE_string("model", "fc", "Options: " + ", ".join(sorted(ARCHITECTURES)))
 tf.app.flags.DEFINE_bool("validate", True, "Validate after all training is complete")
 tf.app.flags.DEFINE_bool("validate_incrementally", False, "Validate after every epoch")
 tf.app.flags.DEFINE_integer("num_images", 1000, "")
+tf.app.flags.DEFINE_integer("subsample", 1, "Keep every n-th frame of each recording.")
 tf.app.flags.DEFINE_float("eval_proportion", 0.2, "")
 tf.app.flags.DEFINE_bool("plot", True, "")
 tf.app.flags.DEFINE_bool("verbose", False, "")
@@ -29,6 +35,7 @@ tf.app.flags.DEFINE_bool("train_online", False, "")
 tf.app.flags.DEFINE_bool("qlearning", False, "")
 tf.app.flags.DEFINE_bool("user_overwrite", False, "")
 tf.app.flags.DEFINE_string("ip", "127.0.0.1", "Specify host IP. Default is local loopback.")
+tf.app.flags.DEFINE_string("emulators", "", "Comma-separated host:port list of emulators to play in lockstep. Default is one emulator at --ip.")
 # LAYER SIZES
 tf.app.flags.DEFINE_integer("cnn_filter_size", 7, "Size of filter.")
 tf.app.flags.DEFINE_integer("cnn_num_filters", 32, "Filter count.")
@@ -41,18 +48,46 @@ tf.app.flags.DEFINE_float("reg_lambda", .01, "Regularization")
 tf.app.flags.DEFINE_integer("num_epochs", 20, "")
 tf.app.flags.DEFINE_float("epsilon", 0.05, "E-greedy exploration rate.")
 
+tf.app.flags.DEFINE_integer("n_step", 1, "Steps of the returns used as online Q-learning targets.")
 tf.app.flags.DEFINE_bool("use_target_net", False, "")
 tf.app.flags.DEFINE_float("tau", 0.001, "Soft target update factor.")
 tf.app.flags.DEFINE_integer("target_q_update_step", 10, "")
 
 # INFRASTRUCTURE
+tf.app.flags.DEFINE_integer("intra_op_threads", 0, "Threads used within a single op, e.g. a convolution. 0 lets TensorFlow pick.")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0, "Ops the learner runs concurrently. 0 lets TensorFlow pick.")
+tf.app.flags.DEFINE_integer("inference_threads", 0, "Threads of a separate inter-op pool for the inferences used to act online. 0 shares the learner's pool.")
+tf.app.flags.DEFINE_string("cpus", "", "CPUs to pin this process to, e.g. 0-3,8. Empty string leaves the affinity unchanged.")
 tf.app.flags.DEFINE_string("data_dir", "./data/data_053017/", "data directory (default ./data)")
 tf.app.flags.DEFINE_string("results_dir", "./results/", "")
+tf.app.flags.DEFINE_bool("stream_data", False, "Stream offline training data from disk instead of loading it into memory.")
+tf.app.flags.DEFINE_integer("shuffle_buffer_size", 10000, "Examples held in the shuffle buffer when streaming data.")
+tf.app.flags.DEFINE_integer("prefetch_batches", 8, "Batches prepared ahead of the training loop when streaming data.")
+tf.app.flags.DEFINE_integer("num_workers", 1, "Processes used to decode and resize images while loading data.")
+tf.app.flags.DEFINE_string("cache_dir", "", "Directory for decoded, resized frames, e.g. ./data/cache/. Empty string (the default) disables the cache.")
+tf.app.flags.DEFINE_string("manifest_dir", "./data/manifests/", "Directory for the per-recording frame manifests. Empty string rebuilds them on every run.")
 tf.app.flags.DEFINE_integer("image_width", 64, "")
 tf.app.flags.DEFINE_integer("image_height", 48, "")
 tf.app.flags.DEFINE_integer("num_channels", 3, "")
 tf.app.flags.DEFINE_integer("batch_size", 10, "")
+tf.app.flags.DEFINE_bool("uint8_input", False, "Feed frames as uint8 and scale them to [0, 1] inside the graph.")
 tf.app.flags.DEFINE_integer("replay_buffer_size", 1000, "")
+tf.app.flags.DEFINE_integer("replay_buffer_mb", 0, "Size the replay buffer to this many MB of RAM instead of --replay_buffer_size. 0 disables it. Not with --replay_compress_frames.")
+tf.app.flags.DEFINE_string("replay_obs_dir", "", "Keep replay buffer frames in a memory-mapped file in this directory. Empty string keeps them in RAM.")
+tf.app.flags.DEFINE_bool("replay_compress_frames", False, "Keep one compressed copy of every distinct replay buffer frame.")
+tf.app.flags.DEFINE_string("snapshot_dir", "", "Directory for snapshots of the full online-training state. Empty string disables them.")
+tf.app.flags.DEFINE_integer("snapshot_every", 1000, "Training steps between snapshots.")
+tf.app.flags.DEFINE_bool("resume", False, "Resume online training from the snapshot in --snapshot_dir, if there is one.")
+tf.app.flags.DEFINE_bool("actor_learner", False, "Play the emulator in a separate actor thread while the learner trains.")
+tf.app.flags.DEFINE_integer("actor_sync_every", 1000, "Steps the actor plays between copies of the learner's weights.")
+tf.app.flags.DEFINE_bool("prioritized_replay", False, "Sample replay transitions in proportion to their TD error.")
+tf.app.flags.DEFINE_float("priority_alpha", 0.6, "Prioritization exponent; 0 is uniform sampling.")
+tf.app.flags.DEFINE_float("priority_beta", 0.4, "Initial importance-sampling exponent, annealed to 1.")
+tf.app.flags.DEFINE_integer("priority_beta_steps", 100000, "Training steps over which priority_beta is annealed to 1.")
+tf.app.flags.DEFINE_integer("train_steps_per_play", 1, "Online training steps per --env_steps_per_play environment steps.")
+tf.app.flags.DEFINE_integer("env_steps_per_play", 0, "Environment steps per --train_steps_per_play training steps. 0 means --batch_size.")
+tf.app.flags.DEFINE_integer("replay_warmup", 0, "Transitions in the replay buffer before online training starts.")
+tf.app.flags.DEFINE_bool("prefetch_replay", False, "Sample the next replay minibatch in a background thread during training.")
 
 ACTIONS = ['w', 'a', 's', 'd', 'j', 'k', 'n']
 ACTION_NAMES = ['up', 'left', 'down', 'right', 'fire', 'back', 'do nothing']
@@ -66,6 +101,69 @@ def initialize_model(session, model):
     print("Flags: " + str(FLAGS.__flags))
     return model
 
+def parse_cpus(cpus):
+    """Parses a CPU list such as "0-3,8" into a sorted list of CPU numbers."""
+    result = set()
+    for part in cpus.split(','):
+        first, _, last = part.strip().partition('-')
+        result.update(range(int(first), int(last or first) + 1))
+    return sorted(result)
+
+# Number of CPUs in a glibc cpu_set_t, as passed to sched_setaffinity/sched_getaffinity.
+CPU_SETSIZE = 1024
+_MASK_WORD_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+
+def _cpu_affinity_call(name, mask):
+    # Python 2 has no os.sched_setaffinity/os.sched_getaffinity, so call libc directly (Linux only).
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, name):
+        raise OSError("%s is not available on this platform" % name)
+    if getattr(libc, name)(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "%s: %s" % (name, os.strerror(errno)))
+
+def set_cpu_affinity(cpus):
+    """Pins the calling thread, and every thread it starts afterwards, to `cpus`."""
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // _MASK_WORD_BITS))()
+    for cpu in cpus:
+        if not 0 <= cpu < CPU_SETSIZE:
+            raise ValueError("Invalid CPU: %d" % cpu)
+        mask[cpu // _MASK_WORD_BITS] |= 1 << (cpu % _MASK_WORD_BITS)
+    _cpu_affinity_call('sched_setaffinity', mask)
+
+def get_cpu_affinity():
+    """The CPUs the calling thread may run on, or all CPUs if that cannot be queried."""
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // _MASK_WORD_BITS))()
+    try:
+        _cpu_affinity_call('sched_getaffinity', mask)
+    except OSError:
+        return list(range(multiprocessing.cpu_count()))
+    return [cpu for cpu in range(CPU_SETSIZE) if (mask[cpu // _MASK_WORD_BITS] >> (cpu % _MASK_WORD_BITS)) & 1]
+
+def configure_cpus():
+    """Pins the process to --cpus, and returns the session config and the run options for acting inference given by
+    the threading flags. Must run before the session is created, which sizes its thread pools by the CPUs available."""
+    if FLAGS.cpus:
+        set_cpu_affinity(parse_cpus(FLAGS.cpus))
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                            inter_op_parallelism_threads=FLAGS.inter_op_threads)
+    inference_run_options = None
+    if FLAGS.inference_threads > 0:
+        # Pool 0 is used by default, i.e. by training; acting inferences ask for pool 1.
+        config.session_inter_op_thread_pool.add().num_threads = FLAGS.inter_op_threads
+        config.session_inter_op_thread_pool.add().num_threads = FLAGS.inference_threads
+        inference_run_options = tf.RunOptions(inter_op_thread_pool=1)
+
+    # Report the effective configuration.
+    cpus = get_cpu_affinity()
+    default = "default (%d)" % len(cpus)
+    print("CPUs: %s" % ",".join(str(cpu) for cpu in cpus))
+    print("Threads: intra-op = %s\tinter-op = %s\tinference inter-op = %s" % (
+        FLAGS.intra_op_threads or default, FLAGS.inter_op_threads or default,
+        FLAGS.inference_threads or "shared with inter-op"))
+    return config, inference_run_options
+
 def record_params():
     dt = str(datetime.datetime.now())
     # Record params
@@ -85,7 +183,8 @@ def run_model():
     tf.set_random_seed(1)
 
     # Get the session.
-    session = tf.Session()
+    session_config, inference_run_options = configure_cpus()
+    session = tf.Session(config=session_config)
 
     # Initialize a FoxNet model.
     foxnet = FoxNetModel(
@@ -104,10 +203,15 @@ def run_model():
                 ACTIONS,
                 ACTION_NAMES,
                 FLAGS.cnn_filter_size,
-                FLAGS.cnn_num_filters
+                FLAGS.cnn_num_filters,
+                uint8_input=FLAGS.uint8_input,
+                actor_network=FLAGS.train_online and FLAGS.actor_learner,
+                n_step=FLAGS.n_step
             )
 
     foxnet.saver = tf.train.Saver(max_to_keep = 3, keep_checkpoint_every_n_hours=4)
+    # Snapshots have their own Saver, so that the saves of model_path never delete the snapshot's checkpoint.
+    foxnet.snapshot_saver = tf.train.Saver(max_to_keep=1)
     model_dir = './models/%s' % (FLAGS.model_dir)
     model_name = '%s' % (FLAGS.model_dir)
     model_path = model_dir + '/' + model_name
@@ -116,14 +220,38 @@ def run_model():
 
     dt = record_params()
 
+    # Restore the network and optimizer state of the latest snapshot; the data manager restores the rest.
+    resume_dir = None
+    if FLAGS.train_online and FLAGS.snapshot_dir:
+        if not os.path.exists(FLAGS.snapshot_dir):
+            os.makedirs(FLAGS.snapshot_dir)
+        checkpoint = tf.train.latest_checkpoint(FLAGS.snapshot_dir)
+        if FLAGS.resume and checkpoint is not None:
+            print('Resuming from snapshot: %s' % checkpoint)
+            foxnet.snapshot_saver.restore(session, checkpoint)
+            resume_dir = FLAGS.snapshot_dir
+
     # Initialize a data manager.
     data_manager = DataManager(FLAGS.verbose)
     if FLAGS.train_online:
         frames_per_state = 1
-        if FLAGS.model == "dqn_3d":
+        if get_architecture(FLAGS.model).multi_frame:
             frames_per_state = FLAGS.frames_per_state
         data_manager.init_online(foxnet, session, FLAGS.batch_size, FLAGS.replay_buffer_size, frames_per_state,
-                                 FLAGS.ip, FLAGS.image_height, FLAGS.image_width, FLAGS.epsilon, FLAGS.user_overwrite)
+                                 parse_emulators(FLAGS.emulators, FLAGS.ip), FLAGS.image_height, FLAGS.image_width, FLAGS.epsilon, FLAGS.user_overwrite,
+                                 prefetch_replay=FLAGS.prefetch_replay, actor_learner=FLAGS.actor_learner,
+                                 actor_sync_every=FLAGS.actor_sync_every, prioritized_replay=FLAGS.prioritized_replay,
+                                 priority_alpha=FLAGS.priority_alpha, priority_beta=FLAGS.priority_beta,
+                                 priority_beta_steps=FLAGS.priority_beta_steps,
+                                 replay_obs_dir=FLAGS.replay_obs_dir or None,
+                                 replay_compress_frames=FLAGS.replay_compress_frames, n_step=FLAGS.n_step,
+                                 replay_memory_budget=FLAGS.replay_buffer_mb * 2**20,
+                                 train_steps_per_play=FLAGS.train_steps_per_play,
+                                 env_steps_per_play=FLAGS.env_steps_per_play, replay_warmup=FLAGS.replay_warmup,
+                                 resume_dir=resume_dir, inference_run_options=inference_run_options)
+    elif FLAGS.stream_data:
+        data_manager.init_streaming(get_data_params(), FLAGS.batch_size, FLAGS.shuffle_buffer_size,
+                                    FLAGS.prefetch_batches)
     else:
         data_manager.init_offline(FLAGS.test, get_data_params(), FLAGS.batch_size)
 
@@ -152,7 +280,8 @@ def run_model():
         # Run Q-learning or classification.
         if FLAGS.qlearning:
             foxnet.run_q_learning(data_manager, session, FLAGS.num_epochs, model_path, save_model=FLAGS.save_model, results_dir=FLAGS.results_dir,
-                                  plot=FLAGS.plot, dt=dt)
+                                  plot=FLAGS.plot, dt=dt, snapshot_dir=FLAGS.snapshot_dir if FLAGS.train_online else None,
+                                  snapshot_every=FLAGS.snapshot_every)
         else:
             foxnet.run_classification(data_manager,
                                       session,
@@ -167,6 +296,9 @@ def run_model():
                                       dt=dt
                                       )
 
+    # Stop background threads before saving
+    data_manager.close()
+
     # Save the model
     if FLAGS.save_model:
         # Save model
@@ -182,6 +314,9 @@ def run_model():
         print("##### VALIDATING ##########################################")
         foxnet.run_validation(data_manager, session, confusion=True, results_dir=FLAGS.results_dir, dt=dt)
 
+    # Stop the decode workers of a streamed dataset, now that validation is done
+    data_manager.close_stream()
+
     # Close session
     session.close()
 
@@ -189,13 +324,17 @@ def get_data_params():
     return {
         "data_dir": FLAGS.data_dir,
         "num_images": FLAGS.num_images,
+        "subsample": FLAGS.subsample,
         "width": FLAGS.image_width,
         "height": FLAGS.image_height,
-        "multi_frame_state": FLAGS.model == "dqn_3d",
+        "multi_frame_state": get_architecture(FLAGS.model).multi_frame,
         "frames_per_state": FLAGS.frames_per_state,
         "actions": ACTIONS,
         "eval_proportion": FLAGS.eval_proportion,
         "image_size": 28,
+        "cache_dir": FLAGS.cache_dir,
+        "manifest_dir": FLAGS.manifest_dir,
+        "num_workers": FLAGS.num_workers,
     }
 
 def main(_):
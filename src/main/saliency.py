@@ -92,7 +92,7 @@ foxnet = FoxNetModel(
                 q_learning='False',
                 lr=0.000004,
                 reg_lambda=-1,
-                dropout=0.5
+                dropout=0.5,
                 use_target_net=False,
                 tau=.99,
                 target_q_update_step=10,
@@ -128,8 +128,9 @@ def get_data_params():
         "image_size": 28,
     }
 
-all_data, _ = load_datasets("test", get_data_params())
-s, a, scores, h = all_data
+(states, actions, scores, h), train_indices, _ = load_datasets("test", get_data_params())
+s = states[train_indices]
+a = actions[train_indices]
 
 print("##### SALIENCY MAPS #######################################")
 # Generate 5 options